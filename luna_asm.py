@@ -1,10 +1,16 @@
 #!/usr/bin/env python3
 
 import os
+import sys
 import argparse
 import io
 import re
-import glob
+import json
+import keyword
+import itertools
+import time
+from array import array
+from collections import OrderedDict
 
 debug_flag = False
 
@@ -769,8 +775,107 @@ class InstructionExtension(object):
         },
     ]
 
+    # op code -> [parameters without '=', parameters with '='], encoded by compile_params
+    operand_params = {
+        'memc': operand_memc_params,
+        'mnts': operand_mnts_params,
+        'mntx': operand_mntx_params,
+        'dstm0': operand_dstm0_params,
+        'dstm1': operand_dstm1_params,
+        'dstm2': operand_dstm2_params,
+        'iow': operand_iow_params,
+        'dprc': operand_dprc_params,
+        'rst': operand_rst_params,
+        'macro': operand_macro_params,
+    }
+
+    # op code -> value of each parameter, these ops take no parameters with '='
+    operand_flags = {
+        'init': operand_init_vals,
+        'smrk': operand_smrk_vals,
+        'cmrk': operand_cmrk_vals,
+    }
+
+    # op code -> parameters whose bits must not be set twice within a merged instruction
+    operand_merge_params = {
+        'mnts': operand_mnts_params[0],
+        'dstm0': operand_dstm0_params[0],
+    }
+
     def __init__(self):
-        print("extension module - [InstructionExtension] loaded")
+        # op code -> bit mask of each parameter checked for conflicts when merging
+        self.merge_masks = {}
+        for op_code, params in self.operand_merge_params.items():
+            self.merge_masks[op_code] = {name: 1 << param['bit'] for name, param in params.items()}
+
+        # the tables below are filled on the first use of an op code, most programs only use a few
+        # op code -> (encoder, op code bits), looked up once per instruction
+        self.op_table = {}
+        # mode and selection counter -> resolver of the ares parameters without '='
+        self.ares_resolvers = [None] * len(self.operand_ares_params)
+
+    def build_tables(self):
+        """
+        fill the lazily built tables up front, for a parser that is kept running
+        """
+        for op_code in self.instruction_dict:
+            if op_code not in self.op_table:
+                self.op_table[op_code] = self.compile_op(op_code)
+        for counter, params in enumerate(self.operand_ares_params):
+            if self.ares_resolvers[counter] is None:
+                self.ares_resolvers[counter] = self.compile_ares_params(params)
+
+    def compile_op(self, op_code):
+        """
+        the (encoder, op code bits) entry of the op table
+        the encoder of the parameter tables has every value already shifted into place
+        """
+        if op_code in self.operand_params:
+            params = self.operand_params[op_code]
+            keyword_codes = {}
+            for name, param in params[0].items():
+                keyword_codes[name] = param['val'] << param['bit']
+            assignment_codes = {}
+            for name, param in params[1].items():
+                codes = {}
+                for val_name, val in param['val'].items():
+                    codes[val_name] = val << param['bit']
+                assignment_codes[name] = (param['bit'], codes)
+            encoder = self.compile_params(keyword_codes, assignment_codes)
+        elif op_code in self.operand_flags:
+            encoder = self.compile_params(self.operand_flags[op_code], {})
+        else:
+            encoder = getattr(self, 'parse_op_' + op_code)
+        return encoder, self.instruction_dict[op_code] << 26
+
+    def compile_params(self, keyword_codes, assignment_codes):
+        """
+        build the encoder of an op code taking 'keyword' and 'name=value' parameters, or '#N' for the raw bits
+        """
+        def encode(operand):
+            if len(operand) < 1:
+                raise ValueError('instruction operand length error')
+            if '#' in operand[0].text:
+                if operand[0].num is None:
+                    raise ValueError('invalid op: ' + operand[0].text)
+                return operand[0].num
+
+            imm = 0
+            for op in operand:
+                if type(op) is not KeyVal:
+                    imm |= keyword_codes[op.text]
+                    continue
+                name = op.key
+                val = op.val
+                if '=' in val or name not in assignment_codes:
+                    raise ValueError('invalid op: ' + op.text)
+                bit, codes = assignment_codes[name]
+                if val.isdecimal():
+                    imm |= int(val) << bit
+                else:
+                    imm |= codes[val]
+            return imm
+        return encode
 
     def ares_started(self, operand):
         operand = operand.replace('\t', ' ').split(',')
@@ -822,32 +927,42 @@ class InstructionExtension(object):
 
         return count
 
-    def merge(self, op_code, operand, op_code_next, operand_next):
+    def merge_group(self, op_code, operand):
+        """
+        start a merge group with the operand of its first instruction
+        """
+        group = MergeGroup(op_code, operand)
+        group.has_hash = '#' in operand
+
+        masks = self.merge_masks.get(op_code)
+        if masks:
+            # the parameters of the first instruction are taken as they are, without conflict check
+            for each in operand.split(','):
+                each = each.strip().replace('{', '').replace('}', '')
+                if each in masks and each not in group.names:
+                    group.names.add(each)
+                    group.mask |= masks[each]
+
+        return group
+
+    def merge_into(self, group, op_code_next, operand_next):
+        """
+        merge the next instruction into the group if applicable, only the next operand is scanned
+        """
+        op_code = group.op_code
         if op_code != op_code_next:
             return False
-        if '#' in operand or '#' in operand_next:
+        if group.has_hash or '#' in operand_next:
             return False
 
-        if op_code not in self.instruction_dict_merge or op_code_next not in self.instruction_dict_merge:
+        if op_code not in self.instruction_dict_merge:
             return False
 
-        bit_dict = {}
-        params_dict = {}
-
-        if op_code == 'mnts':
-            params_dict = self.operand_mnts_params[0]
-
-        if op_code == 'dstm0':
-            params_dict = self.operand_dstm0_params[0]
-
         if op_code == 'ares':
-            count = 0
-
-            # Find the 'ares' start keyword
-            count = self.ares_started(operand)
-            if count != -1:
-                pass
-            else:
+            # Find the 'ares' start keyword, the first two parameters belong to the first instruction
+            if group.ares_count is None:
+                group.ares_count = self.ares_started(group.parts[0])
+            if group.ares_count == -1:
                 raise ValueError("Ares merge error, can't find the start mode and selection")
 
             next_count = self.ares_started(operand_next)
@@ -855,128 +970,112 @@ class InstructionExtension(object):
                 # restart ares
                 return False
 
+            group.parts.append(operand_next)
             return True
 
-        operand = operand.replace('\t', ' ')
-        items = operand.split(',')
-        for each in items:
-            each = (each.lstrip().rstrip())
-            each = each.replace('{', '')
-            each = each.replace('}', '')
-
-            if each in params_dict:
-                if each not in bit_dict:
-                    # bit exists
-                    if params_dict[each]['bit'] in bit_dict:
-                        return False
-                    else:
-                        bit_dict[each] = params_dict[each]['bit']
-
-        operand_next = operand_next.replace('\t', ' ')
-        items_next = operand_next.split(',')
-        for each in items_next:
-            each = (each.lstrip().rstrip())
-            each = each.replace('{', '')
-            each = each.replace('}', '')
-
-            if each in params_dict:
-                if each not in bit_dict:
-                    # bit exists
-                    if params_dict[each]['bit'] in bit_dict.values():
-                        return False
-                    else:
-                        bit_dict[each] = params_dict[each]['bit']
-
+        masks = self.merge_masks.get(op_code)
+        if masks:
+            names = set()
+            mask = 0
+            for each in operand_next.split(','):
+                each = each.strip().replace('{', '').replace('}', '')
+                if each not in masks or each in group.names or each in names:
+                    continue
+                # bit exists
+                if (group.mask | mask) & masks[each]:
+                    return False
+                names.add(each)
+                mask |= masks[each]
+            group.names |= names
+            group.mask |= mask
+
+        group.parts.append(operand_next)
         return True
 
+    def merge(self, op_code, operand, op_code_next, operand_next):
+        return self.merge_into(self.merge_group(op_code, operand), op_code_next, operand_next)
+
     def parse_op(self, op_code, operand, inst_label_list, index):
         """
         process the op code and operand
         """
-        code = 0
-        if op_code in self.instruction_dict:
-            code = (self.instruction_dict[op_code] << 26)
-
-        if op_code == 'memc':
-            code += self.parse_op_memc(operand)
-        if op_code == 'mnts':
-            code += self.parse_op_mnts(operand)
-        if op_code == 'dstm0':
-            code += self.parse_op_dstm0(operand)
-        if op_code == 'ares':
-            code += self.parse_op_ares(operand)
-        if op_code == 'iow':
-            code += self.parse_op_iow(operand)
-        if op_code == 'dprc':
-            code += self.parse_op_dprc(operand)
-        if op_code == 'rst':
-            code += self.parse_op_rst(operand)
-        if op_code == 'init':
-            code += self.parse_op_init(operand)
-        if op_code == 'smrk':
-            code += self.parse_op_smrk(operand)
-        if op_code == 'cmrk':
-            code += self.parse_op_cmrk(operand)
-        if op_code == 'macro':
-            code += self.parse_op_macro(operand)
-        if op_code == 'seti':
-            code += self.parse_op_seti(operand)
-
-        return code
-
-    def parse_op_memc(self, operand):
-        if len(operand) < 1:
-            raise ValueError('instruction operand length error')
-        imm = 0
-        if '#' in operand[0]:
-            imm += (int(operand[0][1:]))
-            return imm
-
-        for op in operand:
-            params = op.split('=')
-            if len(params) == 1:
-                imm |= (self.operand_memc_params[0][params[0]]['val'] << self.operand_memc_params[0][params[0]]['bit'])
-            if len(params) == 2:
-                if params[1].isdecimal():
-                    val = int(params[1])
-                else:
-                    val = self.operand_memc_params[1][params[0]]['val'][params[1]]
-                imm |= (val << self.operand_memc_params[1][params[0]]['bit'])
-            if len(params) > 2:
-                raise ValueError('invalid op: ' + op)
-
-        return imm
-
-    def parse_op_mnts(self, operand):
-        if len(operand) < 1:
-            raise ValueError('instruction operand length error')
-        imm = 0
-        if '#' in operand[0]:
-            imm += (int(operand[0][1:]))
-            return imm
-
-        for op in operand:
-            params = op.split('=')
-            if len(params) == 1:
-                imm |= (self.operand_mnts_params[0][params[0]]['val'] << self.operand_mnts_params[0][params[0]]['bit'])
-            if len(params) == 2:
-                if params[1].isdecimal():
-                    val = int(params[1])
-                else:
-                    val = self.operand_mnts_params[1][params[0]]['val'][params[1]]
-                imm |= (val << self.operand_mnts_params[1][params[0]]['bit'])
-            if len(params) > 2:
-                raise ValueError('invalid op: ' + op)
-
-        return imm
+        entry = self.op_table.get(op_code)
+        if entry is None:
+            if op_code not in self.instruction_dict:
+                return 0
+            entry = self.op_table[op_code] = self.compile_op(op_code)
+        encoder, code = entry
+        return code + encoder(operand)
+
+    def compile_ares_params(self, params):
+        """
+        build the resolver of the ares parameters without '=' for one mode and selection
+        the parameter listed first wins when an operand fits several, as in the table order
+        """
+        keywords = {}  # keyword -> (order, code)
+        patterns = []  # lookahead per pattern parameter, tried in order by one regex
+        pattern_fields = {}  # group name -> (order, bit, group of the number)
+        bit_fields = {}  # name -> (order, bit, width) of the name[xxxx] parameters
+
+        for order, (name, param) in enumerate(params.items()):
+            val = param['val']
+            if isinstance(val, str):
+                group = 'p%d' % order
+                patterns.append('(?=.*?(?P<%s>%s))' % (group, val))
+                pattern_fields[group] = (order, param['bit'], 1 if re.compile(val).groups else 0)
+            elif isinstance(val, dict):
+                for key, key_val in val.items():
+                    if key not in keywords:
+                        keywords[key] = (order, int(key_val) << param['bit'])
+            elif isinstance(val, int):
+                bit_fields[name] = (order, param['bit'], val)
+            else:
+                # Only support assignment statement
+                raise ValueError(name + "parameter unsupport!!!")
+
+        pattern_match = None
+        if patterns:
+            pattern = re.compile('|'.join(patterns), re.S)
+            pattern_match = pattern.match
+            for group, (order, bit, number) in pattern_fields.items():
+                pattern_fields[group] = (order, bit, pattern.groupindex[group] + number)
+        bits_search = re.compile(self.operand_ares_bits_assignment).search
+
+        def resolve(op):
+            found = keywords.get(op)
+
+            if pattern_match is not None:
+                match = pattern_match(op)
+                if match is not None:
+                    order, bit, number = pattern_fields[match.lastgroup]
+                    if found is None or order < found[0]:
+                        found = (order, int(match.group(number)) << bit)
+
+            if bit_fields:
+                match = bits_search(op)
+                if match is not None:
+                    field = bit_fields.get(match.group(1))
+                    if field is not None and (found is None or field[0] < found[0]):
+                        order, bit, width = field
+                        if len(match.group(2)) != width:
+                            raise ValueError("ares instruction " + op + "length can't match")
+                        found = (order, int(match.group(2), base=2) << bit)
+
+            if found is None:
+                raise ValueError('parameter ' + op + " not support")
+            return found[1]
+        return resolve
 
     def parse_op_ares(self, operand):
         if len(operand) < 1:
             raise ValueError('instruction operand length error')
         imm = 0
-        if '#' in operand[0]:
-            imm += (int(operand[0][1:]))
+        if '#' in operand[0].text:
+            if operand[0].num is None:
+                raise ValueError('invalid op: ' + operand[0].text)
+            imm += operand[0].num
             return imm
+        operand = [each.text for each in operand]
 
         counter = 0
 
@@ -1023,7 +1122,12 @@ class InstructionExtension(object):
                 imm += int(self.operand_ares_select[sel]) << 12
 
         operand = operand[2:]
+        if not operand:
+            return imm
 
+        resolve = self.ares_resolvers[counter]
+        if resolve is None:
+            resolve = self.ares_resolvers[counter] = self.compile_ares_params(self.operand_ares_params[counter])
         for op in operand:
             if '=' in op:
                 params = op.split('=')
@@ -1036,272 +1140,7 @@ class InstructionExtension(object):
                 if len(params) > 2:
                     raise ValueError('invalid op: ' + op)
             else:
-                for i in self.operand_ares_params[counter].items():
-                    if isinstance(i[1]['val'], str):
-                        val_list = re.findall(i[1]['val'], op)
-                        if val_list:
-                            imm |= (int(val_list[0]) << i[1]['bit'])
-                            break
-                        continue
-                    elif isinstance(i[1]['val'], dict):
-                        if op in i[1]['val'].keys():
-                            imm |= int(i[1]['val'][op]) << i[1]['bit']
-                            break
-                        else:
-                            continue
-                    elif isinstance(i[1]['val'], int):
-                        # find match data -> [type, binary]
-                        val_list = re.findall(self.operand_ares_bits_assignment, op)
-                        if val_list:
-                            val_list = val_list[0]
-                            if len(val_list) != 2:
-                                raise ValueError("ares instruction trigger error in" + op)
-                            if val_list[0] != i[0]:
-                                continue
-                            if len(val_list[1]) != i[1]['val']:
-                                raise ValueError("ares instruction " + op + "length can't match")
-                            imm |= int(val_list[1], base=2) << self.operand_ares_params[counter][val_list[0]]['bit']
-                            break
-                        else:
-                            continue
-                    else:
-                        # Only support assignment statement
-                        raise ValueError(op + "parameter unsupport!!!")
-                else:
-                    raise ValueError('parameter ' + op + " not support")
-
-        return imm
-
-    def parse_op_mntx(self, operand):
-        if len(operand) < 1:
-            raise ValueError('instruction operand length error')
-        imm = 0
-        if '#' in operand[0]:
-            imm += (int(operand[0][1:]))
-            return imm
-
-        for op in operand:
-            params = op.split('=')
-            if len(params) == 1:
-                imm |= (self.operand_mntx_params[0][params[0]]['val'] << self.operand_mntx_params[0][params[0]]['bit'])
-            if len(params) == 2:
-                if params[1].isdecimal():
-                    val = int(params[1])
-                else:
-                    val = self.operand_mntx_params[1][params[0]]['val'][params[1]]
-                imm |= (val << self.operand_mntx_params[1][params[0]]['bit'])
-            if len(params) > 2:
-                raise ValueError('invalid op: ' + op)
-
-        return imm
-
-    def parse_op_dstm0(self, operand):
-        if len(operand) < 1:
-            raise ValueError('instruction operand length error')
-        imm = 0
-        if '#' in operand[0]:
-            imm += (int(operand[0][1:]))
-            return imm
-
-        for op in operand:
-            params = op.split('=')
-            if len(params) == 1:
-                imm |= (self.operand_dstm0_params[0][params[0]]['val'] << self.operand_dstm0_params[0][params[0]]
-                ['bit'])
-            if len(params) == 2:
-                if params[1].isdecimal():
-                    val = int(params[1])
-                else:
-                    val = self.operand_dstm0_params[1][params[0]]['val'][params[1]]
-                imm |= (val << self.operand_dstm0_params[1][params[0]]['bit'])
-            if len(params) > 2:
-                raise ValueError('invalid op: ' + op)
-
-        return imm
-
-    def parse_op_dstm1(self, operand):
-        if len(operand) < 1:
-            raise ValueError('instruction operand length error')
-        imm = 0
-        if '#' in operand[0]:
-            imm += (int(operand[0][1:]))
-            return imm
-
-        for op in operand:
-            params = op.split('=')
-            if len(params) == 1:
-                imm |= (self.operand_dstm1_params[0][params[0]]['val'] << self.operand_dstm1_params[0][params[0]]
-                ['bit'])
-            if len(params) == 2:
-                if params[1].isdecimal():
-                    val = int(params[1])
-                else:
-                    val = self.operand_dstm1_params[1][params[0]]['val'][params[1]]
-                imm |= (val << self.operand_dstm1_params[1][params[0]]['bit'])
-            if len(params) > 2:
-                raise ValueError('invalid op: ' + op)
-
-        return imm
-
-    def parse_op_dstm2(self, operand):
-        if len(operand) < 1:
-            raise ValueError('instruction operand length error')
-        imm = 0
-        if '#' in operand[0]:
-            imm += (int(operand[0][1:]))
-            return imm
-
-        for op in operand:
-            params = op.split('=')
-            if len(params) == 1:
-                imm |= (self.operand_dstm2_params[0][params[0]]['val'] << self.operand_dstm2_params[0][params[0]]
-                ['bit'])
-            if len(params) == 2:
-                if params[1].isdecimal():
-                    val = int(params[1])
-                else:
-                    val = self.operand_dstm2_params[1][params[0]]['val'][params[1]]
-                imm |= (val << self.operand_dstm2_params[1][params[0]]['bit'])
-            if len(params) > 2:
-                raise ValueError('invalid op: ' + op)
-
-        return imm
-
-    def parse_op_iow(self, operand):
-        if len(operand) < 1:
-            raise ValueError('instruction operand length error')
-        imm = 0
-        if '#' in operand[0]:
-            imm += (int(operand[0][1:]))
-            return imm
-
-        for op in operand:
-            params = op.split('=')
-            if len(params) == 1:
-                imm |= (self.operand_iow_params[0][params[0]]['val'] << self.operand_iow_params[0][params[0]]['bit'])
-            if len(params) == 2:
-                if params[1].isdecimal():
-                    val = int(params[1])
-                else:
-                    val = self.operand_iow_params[1][params[0]]['val'][params[1]]
-                imm |= (val << self.operand_iow_params[1][params[0]]['bit'])
-            if len(params) > 2:
-                raise ValueError('invalid op: ' + op)
-
-        return imm
-
-    def parse_op_dprc(self, operand):
-        if len(operand) < 1:
-            raise ValueError('instruction operand length error')
-        imm = 0
-        if '#' in operand[0]:
-            imm += (int(operand[0][1:]))
-            return imm
-        for op in operand:
-            params = op.split('=')
-            if len(params) == 1:
-                imm |= (self.operand_dprc_params[0][params[0]]['val'] << self.operand_dprc_params[0][params[0]]['bit'])
-            if len(params) == 2:
-                if params[1].isdecimal():
-                    val = int(params[1])
-                else:
-                    val = self.operand_dprc_params[1][params[0]]['val'][params[1]]
-                imm |= (val << self.operand_dprc_params[1][params[0]]['bit'])
-            if len(params) > 2:
-                raise ValueError('invalid op: ' + op)
-
-        return imm
-
-    def parse_op_rst(self, operand):
-        if len(operand) < 1:
-            raise ValueError('instruction operand length error')
-        imm = 0
-        if '#' in operand[0]:
-            imm += (int(operand[0][1:]))
-            return imm
-        for op in operand:
-            params = op.split('=')
-            if len(params) == 1:
-                imm |= (self.operand_rst_params[0][params[0]]['val'] << self.operand_rst_params[0][params[0]]['bit'])
-            if len(params) == 2:
-                if params[1].isdecimal():
-                    val = int(params[1])
-                else:
-                    val = self.operand_rst_params[1][params[0]]['val'][params[1]]
-                imm |= (val << self.operand_rst_params[1][params[0]]['bit'])
-            if len(params) > 2:
-                raise ValueError('invalid op: ' + op)
-
-        return imm
-
-    def parse_op_init(self, operand):
-        if len(operand) < 1:
-            raise ValueError('instruction operand length error')
-        imm = 0
-        if '#' in operand[0]:
-            imm += (int(operand[0][1:]))
-            return imm
-        for op in operand:
-            params = op.split('=')
-            if len(params) == 1:
-                imm |= (self.operand_init_vals[params[0]])
-            if len(params) > 1:
-                raise ValueError('invalid op: ' + op)
-
-        return imm
-
-    def parse_op_smrk(self, operand):
-        if len(operand) < 1:
-            raise ValueError('instruction operand length error')
-        imm = 0
-        if '#' in operand[0]:
-            imm += (int(operand[0][1:]))
-            return imm
-        for op in operand:
-            params = op.split('=')
-            if len(params) == 1:
-                imm |= (self.operand_smrk_vals[params[0]])
-            if len(params) > 1:
-                raise ValueError('invalid op: ' + op)
-
-        return imm
-
-    def parse_op_cmrk(self, operand):
-        if len(operand) < 1:
-            raise ValueError('instruction operand length error')
-        imm = 0
-        if '#' in operand[0]:
-            imm += (int(operand[0][1:]))
-            return imm
-        for op in operand:
-            params = op.split('=')
-            if len(params) == 1:
-                imm |= (self.operand_cmrk_vals[params[0]])
-            if len(params) > 1:
-                raise ValueError('invalid op: ' + op)
-
-        return imm
-
-    def parse_op_macro(self, operand):
-        if len(operand) < 1:
-            raise ValueError('instruction operand length error')
-        imm = 0
-        if '#' in operand[0]:
-            imm += (int(operand[0][1:]))
-            return imm
-        for op in operand:
-            params = op.split('=')
-            if len(params) == 1:
-                imm |= (self.operand_macro_params[0][params[0]]['val'] << self.operand_macro_params[0][params[0]]
-                ['bit'])
-            if len(params) == 2:
-                if params[1].isdecimal():
-                    val = int(params[1])
-                else:
-                    val = self.operand_macro_params[1][params[0]]['val'][params[1]]
-                imm |= (val << self.operand_macro_params[1][params[0]]['bit'])
-            if len(params) > 2:
-                raise ValueError('invalid op: ' + op)
+                imm |= resolve(op)
 
         return imm
 
@@ -1309,6 +1148,7 @@ class InstructionExtension(object):
         if len(operand) < 1:
             raise ValueError('instruction operand length error')
         imm = 0
+        operand = [each.text for each in operand]
 
         mode = operand[0]
         operand = operand[1:]
@@ -1364,24 +1204,317 @@ class InstructionExtension(object):
         return imm
 
 
-class InstFuncLabel:
+class MergeGroup(object):
+    """
+    consecutive instructions being merged into one, with the parameters and bits they already use
+    """
+    def __init__(self, op_code, operand):
+        self.op_code = op_code
+        self.parts = [operand]
+        self.names = set()
+        self.mask = 0
+        self.has_hash = False
+        self.ares_count = None
+
+    def operand(self):
+        return ','.join(self.parts)
+
+
+class TextTable(object):
+    """
+    interned texts, every distinct text is kept once and referred to by its id
+    """
     def __init__(self):
+        self.texts = []
+        self.ids = {}
+
+    def id(self, text):
+        text_id = self.ids.get(text)
+        if text_id is None:
+            text_id = self.ids[text] = len(self.texts)
+            self.texts.append(text)
+        return text_id
+
+
+class InstFuncLabel:
+    """
+    compact store of instructions and their labels
+    an instruction is kept as the ids of its op code and operand text in text_table, which stores may share,
+    and a label only takes an entry where there is one
+    """
+    def __init__(self, text_table=None):
         self.size = 0
-        self.list_inst = []
-        self.list_label = []
+        self.text_table = TextTable() if text_table is None else text_table
+        self.op_ids = array('I')
+        self.operand_ids = array('I')
+        # position -> label, of the labelled instructions only
+        self.labels = {}
+        # label -> position of its first occurrence
+        self.label_pos = {}
 
     def find_label_pos(self, label):
-        return self.list_label.index(label)
+        if label not in self.label_pos:
+            raise ValueError('label not found: ' + label)
+        return self.label_pos[label]
 
     def add(self, inst, label):
-        self.list_inst.append(inst)
-        self.list_label.append(label)
+        index_op = inst.find(' ')
+        if index_op < 0:
+            index_op = len(inst)
+        self.op_ids.append(self.text_table.id(inst[:index_op]))
+        self.operand_ids.append(self.text_table.id(inst[index_op:]))
+        if label:
+            self.labels[self.size] = label
+            if label not in self.label_pos:
+                self.label_pos[label] = self.size
+        self.size += 1
+
+    def extend(self, records):
+        for inst, label in records:
+            self.add(inst, label)
+        return self
+
+    def inst(self, index):
+        texts = self.text_table.texts
+        return texts[self.op_ids[index]] + texts[self.operand_ids[index]]
+
+    def label(self, index):
+        return self.labels.get(index, '')
+
+    def iter_records(self):
+        """
+        the (instruction, label) records
+        """
+        texts = self.text_table.texts
+        op_ids = self.op_ids
+        operand_ids = self.operand_ids
+        labels = self.labels
+        for index in range(self.size):
+            yield texts[op_ids[index]] + texts[operand_ids[index]], labels.get(index, '')
+
+    def replace(self, records):
+        """
+        overwrite the store with the records, in place
+        the records may be read from this store, as long as no record is stored before the one at its position is read
+        """
+        text_id = self.text_table.id
+        op_ids = self.op_ids
+        operand_ids = self.operand_ids
+        labels = self.labels
+        size = 0
+        for inst, label in records:
+            index_op = inst.find(' ')
+            if index_op < 0:
+                index_op = len(inst)
+            if size < len(op_ids):
+                op_ids[size] = text_id(inst[:index_op])
+                operand_ids[size] = text_id(inst[index_op:])
+            else:
+                op_ids.append(text_id(inst[:index_op]))
+                operand_ids.append(text_id(inst[index_op:]))
+            if label:
+                labels[size] = label
+            elif size in labels:
+                del labels[size]
+            size += 1
+
+        del op_ids[size:]
+        del operand_ids[size:]
+        for index in [index for index in labels if index >= size]:
+            del labels[index]
+        self.size = size
+        self.label_pos = {}
+        for index in sorted(labels):
+            if labels[index] not in self.label_pos:
+                self.label_pos[labels[index]] = index
+
+    def length(self):
+        return self.size
+
+
+class LabelTable:
+    """
+    label positions of a merged instruction stream, without keeping the instructions
+    """
+    def __init__(self):
+        self.size = 0
+        self.label_pos = {}
+
+    def find_label_pos(self, label):
+        if label not in self.label_pos:
+            raise ValueError('label not found: ' + label)
+        return self.label_pos[label]
+
+    def add(self, label):
+        if label and label not in self.label_pos:
+            self.label_pos[label] = self.size
         self.size += 1
 
+    def add_labels(self, labels, size):
+        """
+        add size positions at once, labels: position among them -> label
+        """
+        for index in sorted(labels):
+            if labels[index] not in self.label_pos:
+                self.label_pos[labels[index]] = self.size + index
+        self.size += size
+
     def length(self):
         return self.size
 
 
+class FunctionLabels(object):
+    """
+    label table seen by the branches of one function, noting every label they look up
+    refs: label -> its position relative to the start of the function
+    """
+    def __init__(self, label_table, start):
+        self.label_table = label_table
+        self.start = start
+        self.refs = {}
+
+    def find_label_pos(self, label):
+        pos = self.label_table.find_label_pos(label)
+        self.refs[label] = pos - self.start
+        return pos
+
+
+class ObjectLabels(object):
+    """
+    label table of a relocatable object, a label the file does not define is left to the linker
+    relocations: [position, label] of every branch to such a label, encoded with a zero offset
+    index is the position of the instruction being encoded
+    """
+    def __init__(self, label_table):
+        self.label_table = label_table
+        self.relocations = []
+        self.index = 0
+
+    def find_label_pos(self, label):
+        if label in self.label_table.label_pos:
+            return self.label_table.label_pos[label]
+        self.relocations.append([self.index, label])
+        return self.index
+
+
+def text_to_int(text):
+    try:
+        return int(text)
+    except ValueError:
+        return None
+
+
+class Operand(object):
+    """
+    an operand of an instruction, parsed once from its text
+    num is the number after the first character, as in r5 or #5, mem the one inside [r5]; None if not a number
+    """
+    __slots__ = ('text', 'num', 'mem')
+
+    def __init__(self, text, num=None):
+        self.text = text
+        if num is None:
+            num = text_to_int(text[1:])
+            if '[' in text or ']' in text:
+                self.mem = text_to_int(text.replace('[', '').replace(']', '')[1:])
+            else:
+                self.mem = num
+        else:
+            self.mem = num
+        self.num = num
+
+    def __repr__(self):
+        return repr(self.text)
+
+
+class Reg(Operand):
+    """
+    a register rN, sp, lr, pc and st are turned into their rN
+    """
+    __slots__ = ()
+
+
+class Imm(Operand):
+    """
+    an immediate number #N, #0xN or #0bN
+    """
+    __slots__ = ()
+
+
+class Mem(Operand):
+    """
+    a memory reference [rN]
+    """
+    __slots__ = ()
+
+
+class RegRange(Operand):
+    """
+    a register range rA-rB of ldm/stm/push/pop, last is None if rB is not a register
+    """
+    __slots__ = ('first', 'last')
+
+    def __init__(self, text, first, last):
+        Operand.__init__(self, text)
+        self.first = first
+        self.last = last
+
+
+class KeyVal(Operand):
+    """
+    a key=value parameter of the extension instructions
+    """
+    __slots__ = ('key', 'val')
+
+    def __init__(self, text, key, val):
+        Operand.__init__(self, text)
+        self.key = key
+        self.val = val
+
+
+class Word(Operand):
+    """
+    anything else, a label or a keyword
+    """
+    __slots__ = ()
+
+
+register_alias = {
+    'sp': 'r31',
+    'lr': 'r30',
+    'pc': 'r29',
+    'st': 'r28',
+}
+
+
+def parse_operand(item):
+    """
+    turn one comma separated item of an instruction into its operand record
+    """
+    text = item.strip().replace('{', '').replace('}', '')
+    text = register_alias.get(text, text)
+
+    if text.startswith('#'):
+        if '0x' in text:
+            return Imm(text, int(text[1:], 16))
+        if '0b' in text:
+            return Imm(text, int(text[1:], 2))
+        return Imm(text)
+    if text.startswith('[') and text.endswith(']'):
+        return Mem(text)
+    if '=' in text:
+        key, sep, val = text.partition('=')
+        return KeyVal(text, key, val)
+    if '-' in text:
+        regs = text.split('-')
+        first = text_to_int(regs[0][1:])
+        if first is not None:
+            return RegRange(text, first, text_to_int(regs[1][1:]))
+    if text.startswith('r') and text_to_int(text[1:]) is not None:
+        return Reg(text)
+    return Word(text)
+
+
 class InstructionParser(object):
 
     instruction_dict = {
@@ -1480,16 +1613,248 @@ class InstructionParser(object):
 
     inst_extension = None
 
+    # a Profile when the stages of the assembly are timed
+    profile = None
+
     
     IMM_BOTH = 2  
     IMM_SIGNED = 1  
     IMM_UNSIGNED = 0
 
+    # operand kinds of the instruction_fields layouts
+    FIELD_REG = 0  # rN, the register number at bit
+    FIELD_MEM = 1  # [rN], the register number at bit
+    FIELD_IMM = 2  # #N, an immediate number of width bits at bit
+    FIELD_SRC = 3  # rN at bit, or #N at bit 0 with SRC_IMM set
+    FIELD_HASH_IMM = 4  # like FIELD_IMM, but the '#' must be written out
+
+    SRC_IMM = (0b1 << 24)  # the source operand is an immediate number
+    SRC_UNSIGNED = (0b1 << 25)  # an IMM_BOTH immediate number above the signed range
+
+    # field layout -> operand fields in order
+    # a field is (kind, bit) for registers, (kind, bit, width, sign[, bits set by a register source]) otherwise
+    instruction_fields = {
+        'jump': [(FIELD_IMM, 0, 24, IMM_SIGNED)],
+        'repeat': [(FIELD_IMM, 24, 1, IMM_UNSIGNED), (FIELD_IMM, 8, 16, IMM_UNSIGNED), (FIELD_IMM, 0, 5, IMM_UNSIGNED)],
+        'ldro': [(FIELD_REG, 20), (FIELD_REG, 15), (FIELD_HASH_IMM, 0, 15, IMM_SIGNED)],
+        'lea': [(FIELD_REG, 21), (FIELD_REG, 16), (FIELD_HASH_IMM, 0, 16, IMM_SIGNED)],
+        'ldr': [(FIELD_REG, 15), (FIELD_MEM, 8)],
+        'setr': [(FIELD_REG, 16), (FIELD_IMM, 21, 5, IMM_UNSIGNED), (FIELD_IMM, 0, 16, IMM_UNSIGNED)],
+        'setr_mod': [(FIELD_REG, 16), (FIELD_IMM, 0, 16, IMM_UNSIGNED)],  # the mode is part of the op code
+        'gopr': [(FIELD_IMM, 21, 3, IMM_UNSIGNED), (FIELD_REG, 16), (FIELD_SRC, 8, 16, IMM_BOTH)],
+        'gopr_mod': [(FIELD_REG, 16), (FIELD_SRC, 8, 16, IMM_BOTH)],  # the mode is part of the op code
+        'logic': [(FIELD_REG, 16), (FIELD_SRC, 8, 16, IMM_UNSIGNED)],
+        'shift': [(FIELD_REG, 16), (FIELD_SRC, 8, 5, IMM_UNSIGNED)],
+        'mul': [(FIELD_REG, 16), (FIELD_REG, 8)],
+        'mov': [(FIELD_REG, 16), (FIELD_SRC, 8, 16, IMM_BOTH, (0b1 << 25))],
+    }
+
+    # operand records kept by tokenize_operand before starting over
+    operand_cache_size = 65536
+    # machine codes kept by encode_instruction, the least recently used one is dropped first
+    encode_cache_size = 65536
+
+    # how an entry of the op table calls its encoder
+    OP_PLAIN = 0  # encoder(operand)
+    OP_LABEL = 1  # encoder(operand, inst_label_list, index)
+
+    # op code -> [encoder, fixed bits besides the op code, call kind]
+    # the encoder is a layout of instruction_fields, or else a parse_op_* method
+    op_dispatch = {
+        'jump': ['jump', 0, OP_PLAIN],
+        'repeat': ['repeat', 0, OP_PLAIN],
+        'wait': ['parse_op_wait', 0, OP_PLAIN],
+        'cmp': ['gopr_mod', 0, OP_PLAIN],
+        'b': ['parse_op_b', (0b110 << 19), OP_LABEL],
+        'bl': ['parse_op_b', (0b1 << 22) + (0b110 << 19), OP_LABEL],  # branch with LR updated
+        'bx': ['parse_op_b', (0b110 << 19), OP_LABEL],
+        'bgt': ['parse_op_b', (0b000 << 19), OP_LABEL],
+        'beq': ['parse_op_b', (0b010 << 19), OP_LABEL],
+        'blt': ['parse_op_b', (0b100 << 19), OP_LABEL],
+        'bne': ['parse_op_b', (0b011 << 19), OP_LABEL],
+        'ble': ['parse_op_b', (0b001 << 19), OP_LABEL],
+        'bge': ['parse_op_b', (0b101 << 19), OP_LABEL],
+        'ldro': ['ldro', 0, OP_PLAIN],
+        'lea': ['lea', 0, OP_PLAIN],
+        'ldr': ['ldr', 0, OP_PLAIN],
+        'ldrb': ['ldr', (0b1 << 25) + (0b10 << 21), OP_PLAIN],
+        'ldrh': ['ldr', (0b1 << 25) + (0b01 << 21), OP_PLAIN],
+        'ldrsb': ['ldr', (0b10 << 21), OP_PLAIN],
+        'ldrsh': ['ldr', (0b01 << 21), OP_PLAIN],
+        'ldm': ['parse_op_ldm', 0, OP_PLAIN],
+        'pop': ['parse_op_pop', 0, OP_PLAIN],
+        'stro': ['ldro', 0, OP_PLAIN],
+        'str': ['ldr', 0, OP_PLAIN],
+        'strb': ['ldr', (0b1 << 25) + (0b10 << 21), OP_PLAIN],
+        'strh': ['ldr', (0b1 << 25) + (0b01 << 21), OP_PLAIN],
+        'strsb': ['ldr', (0b10 << 21), OP_PLAIN],
+        'strsh': ['ldr', (0b01 << 21), OP_PLAIN],
+        'stm': ['parse_op_stm', 0, OP_PLAIN],
+        'push': ['parse_op_push', 0, OP_PLAIN],
+        'setr': ['setr', 0, OP_PLAIN],
+        'setrh': ['setr_mod', (0b00011 << 21), OP_PLAIN],  # only apply to 16 MSB, preserve the 16 LSB
+        'setrl': ['setr_mod', (0b01100 << 21), OP_PLAIN],  # only apply to 16 LSB, preserve the 16 MSB
+        'setih': ['parse_op_setih', 0, OP_PLAIN],
+        'setil': ['parse_op_setil', 0, OP_PLAIN],
+        'gopr': ['gopr', 0, OP_PLAIN],
+        'addl': ['gopr_mod', (0b010 << 21), OP_PLAIN],  # only apply to 16 LSB
+        'addm': ['gopr_mod', (0b001 << 21), OP_PLAIN],  # only apply to 16 MSB
+        'add': ['gopr_mod', (0b000 << 21), OP_PLAIN],  # immediate with signed extended & apply to the word
+        'subl': ['gopr_mod', (0b110 << 21), OP_PLAIN],  # only apply to 16 LSB
+        'subm': ['gopr_mod', (0b101 << 21), OP_PLAIN],  # only apply to 16 MSB
+        'sub': ['gopr_mod', (0b100 << 21), OP_PLAIN],  # immediate with signed extended & apply to the word
+        # bit 25 reserved 1 for AND and ORR
+        'andl': ['logic', (0b1 << 25) + (0b10 << 21), OP_PLAIN],  # only apply to 16 LSB
+        'andm': ['logic', (0b1 << 25) + (0b01 << 21), OP_PLAIN],  # only apply to 16 MSB
+        'and': ['logic', (0b1 << 25) + (0b00 << 21), OP_PLAIN],  # immediate with 0 extended & apply to the word
+        'notl': ['logic', (0b10 << 21), OP_PLAIN],
+        'notm': ['logic', (0b01 << 21), OP_PLAIN],
+        'not': ['logic', (0b00 << 21), OP_PLAIN],
+        'orrl': ['logic', (0b1 << 25) + (0b10 << 21), OP_PLAIN],
+        'orrm': ['logic', (0b1 << 25) + (0b01 << 21), OP_PLAIN],
+        'orr': ['logic', (0b1 << 25) + (0b00 << 21), OP_PLAIN],
+        'xorl': ['logic', (0b10 << 21), OP_PLAIN],
+        'xorm': ['logic', (0b01 << 21), OP_PLAIN],
+        'xor': ['logic', (0b00 << 21), OP_PLAIN],
+        'asr': ['shift', (0b1 << 25), OP_PLAIN],
+        'lsr': ['shift', 0, OP_PLAIN],
+        'lsl': ['shift', 0, OP_PLAIN],
+        'mul': ['mul', (0b100 << 21), OP_PLAIN],
+        'muls': ['mul', (0b000 << 21), OP_PLAIN],
+        'mulsb': ['mul', (0b010 << 21), OP_PLAIN],
+        'mulb': ['mul', (0b110 << 21), OP_PLAIN],
+        'mulshl': ['mul', (0b001 << 21), OP_PLAIN],
+        'mulhl': ['mul', (0b101 << 21), OP_PLAIN],
+        'mulshm': ['mul', (0b011 << 21), OP_PLAIN],
+        'mulhm': ['mul', (0b111 << 21), OP_PLAIN],
+        'mov': ['mov', 0, OP_PLAIN],
+        'movb': ['mov', (0b10 << 21), OP_PLAIN],  # only apply to 8 LSB
+        'movh': ['mov', (0b11 << 21), OP_PLAIN],  # only apply to 16 MSB
+        'movl': ['mov', (0b01 << 21), OP_PLAIN],  # only apply to 16 LSB
+        'cmov': ['mov', (0b110 << 21), OP_PLAIN],
+        'cmoveq': ['mov', (0b010 << 21), OP_PLAIN],
+        'cmovgt': ['mov', (0b000 << 21), OP_PLAIN],
+        'cmovlt': ['mov', (0b100 << 21), OP_PLAIN],
+        'cmovne': ['mov', (0b011 << 21), OP_PLAIN],
+        'cmovle': ['mov', (0b001 << 21), OP_PLAIN],
+        'cmovge': ['mov', (0b101 << 21), OP_PLAIN],
+    }
+
     def __init__(self, extension=False):
         if extension == True:
             self.inst_extension = InstructionExtension()
+        # item text -> operand record, the operands of a program repeat a lot
+        self.operand_records = {}
+        # instruction text -> machine code, for the op codes whose code does not depend on the position
+        # kept in least to most recently used order
+        self.encode_cache = OrderedDict()
+        self.encode_hits = 0
+        self.encode_misses = 0
+        self.layout_encoders = {}
+        for layout, fields in self.instruction_fields.items():
+            self.layout_encoders[layout] = self.compile_fields(fields)
+        self.op_table = self.build_op_table()
+        # branches to a label are encoded relative to their position, they are never cached
+        self.position_ops = {op_code for op_code, entry in self.op_table.items() if entry[2] == self.OP_LABEL}
+
+    def build_op_table(self):
+        """
+        compile op_dispatch into op code -> (encoder, fixed code, call kind)
+        """
+        op_table = {}
+        for op_code, (encoder, fixed, kind) in self.op_dispatch.items():
+            code = (self.instruction_dict[op_code] << 26) + fixed
+            if encoder in self.layout_encoders:
+                op_table[op_code] = (self.layout_encoders[encoder], code, kind)
+            else:
+                op_table[op_code] = (getattr(self, encoder), code, kind)
 
-    def imm_validate(self, val, bits, signed):
+        return op_table
+
+    def compile_field(self, field):
+        """
+        build the encoder of one operand field, with its mask and range worked out up front
+        """
+        kind = field[0]
+        bit = field[1]
+
+        if kind == self.FIELD_REG:
+            def encode(operand):
+                if operand.num is None:
+                    raise ValueError('invalid register: ' + operand.text)
+                return operand.num << bit
+            return encode
+
+        if kind == self.FIELD_MEM:
+            def encode(operand):
+                if operand.mem is None:
+                    raise ValueError('invalid memory reference: ' + operand.text)
+                return operand.mem << bit
+            return encode
+
+        width = field[2]
+        signed = field[3]
+        min_val, max_val = self.imm_range(width, signed)
+        mask = (1 << width) - 1
+
+        if kind == self.FIELD_IMM or kind == self.FIELD_HASH_IMM:
+            hash_only = (kind == self.FIELD_HASH_IMM)
+
+            def encode(operand):
+                if hash_only and type(operand) is not Imm:
+                    raise ValueError('the immediate data format error')
+                val = operand.num
+                if val is None:
+                    raise ValueError('invalid immediate number: ' + operand.text)
+                if val < min_val or val > max_val:
+                    raise ValueError('the immediate number is out of range [%d : %d]' % (min_val, max_val))
+                return (val & mask) << bit
+            return encode
+
+        if kind == self.FIELD_SRC:
+            reg_code = field[4] if len(field) > 4 else 0
+            imm_code = self.SRC_IMM
+            unsigned_code = self.SRC_UNSIGNED + self.SRC_IMM
+            # values above the signed range are flagged when the immediate can be either
+            signed_max = max_val
+            if signed == self.IMM_BOTH:
+                signed_max = (1 << (width - 1)) - 1
+
+            def encode(operand):
+                val = operand.num
+                if val is None:
+                    raise ValueError('invalid operand: ' + operand.text)
+                if type(operand) is Imm:
+                    if val < min_val or val > max_val:
+                        raise ValueError('the immediate number is out of range [%d : %d]' % (min_val, max_val))
+                    if val > signed_max:
+                        return unsigned_code + (val & mask)
+                    return imm_code + (val & mask)
+                return reg_code + (val << bit)
+            return encode
+
+        raise ValueError('unknown operand field kind: ' + str(kind))
+
+    def compile_fields(self, fields):
+        """
+        build the encoder of an operand field layout
+        """
+        field_encoders = [self.compile_field(field) for field in fields]
+        count = len(field_encoders)
+
+        def encode(operand):
+            if len(operand) != count:
+                raise ValueError('instruction operand length not equal to %d' % count)
+            code = 0
+            for encode_field, each in zip(field_encoders, operand):
+                code += encode_field(each)
+            return code
+        return encode
+
+    def imm_range(self, bits, signed):
+        """
+        the [min, max] range of an immediate number
+        """
         if bits < 1 or bits > 32:
             raise ValueError('the immediate number has invalid bits')
         if signed != self.IMM_SIGNED and signed != self.IMM_UNSIGNED and signed != self.IMM_BOTH:
@@ -1507,676 +1872,207 @@ class InstructionParser(object):
             max_val = ((2 ** bits) - 1)
             min_val = (-(2 ** (bits - 1)))
 
+        return min_val, max_val
+
+    def imm_validate(self, val, bits, signed):
+        min_val, max_val = self.imm_range(bits, signed)
         if val < min_val or val > max_val:
             raise ValueError('the immediate number is out of range [%d : %d]' % (min_val, max_val))
 
-    def parse_op_jump(self, operand):
-        if len(operand) != 1:
-            raise ValueError('instruction operand length not equal to 1')
-
-        dst = operand[0]
-        self.imm_validate(int(dst[1:]), 24, self.IMM_SIGNED)
-
-        imm = 0
-
-        if '-' in dst:
-            imm += (0x1000000 - int(dst[2:]))
-        else:
-            imm += int(dst[1:])
-
-        return imm
-
-    def parse_op_repeat(self, operand):
-        if len(operand) != 3:
-            raise ValueError('instruction operand length not equal to 3')
-
-        loop_id = operand[0]
-        self.imm_validate(int(loop_id[1:]), 1, self.IMM_UNSIGNED)
-        loop_num = operand[1]
-        self.imm_validate(int(loop_num[1:]), 16, self.IMM_UNSIGNED)
-        offset = operand[2]
-        self.imm_validate(int(offset[1:]), 5, self.IMM_UNSIGNED)
-
-        imm = 0
-        imm += (int(loop_id[1:]) << 24)
-        imm += (int(loop_num[1:]) << 8)
-        imm += (int(offset[1:]))
-
-        return imm
-
     def parse_op_wait(self, operand):
         if len(operand) < 1:
             raise ValueError('instruction operand length error')
         imm = 0
-        if '#' in operand[0]:
-            self.imm_validate(int(operand[0][1:]), 26, self.IMM_UNSIGNED)
-            imm += (int(operand[0][1:]))
+        if '#' in operand[0].text:
+            if operand[0].num is None:
+                raise ValueError('invalid immediate number: ' + operand[0].text)
+            self.imm_validate(operand[0].num, 26, self.IMM_UNSIGNED)
+            imm += operand[0].num
             return imm
 
         for each in operand:
+            each = each.text
             if each not in self.operand_wait:
-                if re.match('id([0-3]?[0-9]?)', each) != None:
+                if each.startswith('id'):
                     imm += (int(each[2:]) << 8)
                 else:
-                    print('********************************')
-                    print('unrecognized operand: ' + each + '\n')
-                    print('supported operands for WAIT: ')
-                    print(self.operand_wait.keys())
-                    print('********************************\n')
-                    raise ValueError('operand unrecognized')
+                    raise ValueError('operand unrecognized: ' + each + ', supported operands for WAIT: ' +
+                                     ', '.join(self.operand_wait))
             else:
                 imm += (self.operand_wait[each])
 
         return imm
 
-    def parse_op_cmp(self, operand):
-        if len(operand) != 2:
-            raise ValueError('instruction operand length not equal to 2')
-
-        dst = operand[0]
-        src = operand[1]
-
-        imm = 0
-        if '#' in src:
-            self.imm_validate(int(src[1:]), 16, self.IMM_BOTH)
-            imm += (1 << 24)
-            if '-' in src:
-                imm += (0x10000 - int(src[2:]))
-            else:
-                imm += int(src[1:])
-            if int(src[1:]) > 0x7FFF:
-                imm += (0b1 << 25)
-        else:
-            imm += (int(src[1:]) << 8)
-        imm += (int(dst[1:]) << 16)
-
-        return imm
-
-    def parse_op_b(self, operand, cond, inst_label_list, index):
-        if len(operand) != 1:
-            raise ValueError('instruction operand length not equal to 1')
+    def parse_op_b(self, operand, inst_label_list, index):
+        if len(operand) != 1:
+            raise ValueError('instruction operand length not equal to 1')
 
         dst = operand[0]
 
         imm = 0
 
-        imm += (cond << 19)
-
-        if dst.startswith('#'):
-            self.imm_validate(int(dst[1:]), 16, self.IMM_SIGNED)
+        if type(dst) is Imm:
+            if dst.num is None:
+                raise ValueError('invalid immediate number: ' + dst.text)
+            self.imm_validate(dst.num, 16, self.IMM_SIGNED)
             imm += (0b1 << 24)
-            if '-' in dst:
-                imm += (0x10000 - int(dst[2:]))
-            else:
-                imm += int(dst[1:])
-        elif re.match('r([0-3]?[0-9]?)', dst) != None:
-            imm += (int(dst[1:]) << 8)
+            imm += (dst.num & 0xFFFF)
+        elif dst.text.startswith('r'):
+            if dst.num is None:
+                raise ValueError('invalid register: ' + dst.text)
+            imm += (dst.num << 8)
             imm += (0b1 << 23)  # direct pc mode
         else:  # label needs an offset
             imm += (1 << 24)
-            dst_pos = inst_label_list.find_label_pos(dst)
+            dst_pos = inst_label_list.find_label_pos(dst.text)
             offset = (dst_pos - index)
             if offset > 32767 or offset < -32768:
-                raise ValueError('b instruction has an out range offset: ' + offset)
+                raise ValueError('b instruction has an out range offset: ' + str(offset))
             if offset < 0:
                 offset = 0x10000 + offset
             imm += offset
 
         return imm
 
-    def parse_op_ldro(self, operand):
-        if len(operand) != 3:
-            raise ValueError('instruction operand length not equal to 3')
-
-        dst = operand[0]
-        src = operand[1]
-        imm = operand[2]
-
-        data = 0
-        data += (int(dst[1:]) << 20)
-        data += (int(src[1:]) << 15)
-
-        if '#' in imm:
-            self.imm_validate(int(imm[1:]), 15, self.IMM_SIGNED)
-            if '-' in imm:
-                data += (0x8000 - int(imm[2:]))
-            else:
-                data += int(imm[1:])
-        else:
-            raise ValueError('the immediate data format error')
-
-        return data
-
-    def parse_op_lea(self, operand):
-        if len(operand) != 3:
-            raise ValueError('instruction operand length not equal to 3')
-
-        dst = operand[0]
-        src = operand[1]
-        imm = operand[2]
-
-        data = 0
-        data += (int(dst[1:]) << 21)
-        data += (int(src[1:]) << 16)
-
-        if '#' in imm:
-            self.imm_validate(int(imm[1:]), 16, self.IMM_SIGNED)
-            if '-' in imm:
-                data += (0x10000 - int(imm[2:]))
-            else:
-                data += int(imm[1:])
-        else:
-            raise ValueError('the immediate data format error')
-
-        return data
-
-    def parse_op_ldr(self, operand):
-        if len(operand) != 2:
-            raise ValueError('instruction operand length not equal to 2')
-
-        dst = operand[0]
-        src = operand[1]
-
-        imm = 0
-        imm += (int(dst[1:]) << 15)
-        if '[' in src:
-            src = src.replace('[', '')
-        if ']' in src:
-            src = src.replace(']', '')
-
-        imm += (int(src[1:]) << 8)
-
-        return imm
-
-    def parse_op_ldrb(self, operand):
-        return (0b1 << 25) + (0b10 << 21) + self.parse_op_ldr(operand)
-
-    def parse_op_ldrh(self, operand):
-        return (0b1 << 25) + (0b01 << 21) + self.parse_op_ldr(operand)
-
-    def parse_op_ldrsb(self, operand):
-        return (0b10 << 21) + self.parse_op_ldr(operand)
-
-    def parse_op_ldrsh(self, operand):
-        return (0b01 << 21) + self.parse_op_ldr(operand)
+    def register_list_head(self, operand):
+        """
+        the first register of a register list operand, rA of rA-rB
+        """
+        if type(operand) is RegRange:
+            return self.tokenize_operand('r%d' % operand.first)
+        raise ValueError('reglist is invalid')
 
     def parse_op_ldm(self, operand):
-        reglist = []
-        if '-' in operand[1]:
-            reglist.append(1)
-            regs = operand[1].split('-')
-            operand[1] = regs[0]
-            rng = int(regs[1][1:]) - int(regs[0][1:])
+        regs = operand[1:]
+        if '-' in regs[0].text:
+            head = self.register_list_head(regs[0])
+            if regs[0].last is None:
+                raise ValueError('reglist is invalid')
+            rng = regs[0].last - regs[0].first
             if rng > 7 or rng < 0:
                 raise ValueError('reglist is invalid')
-            for each in range(rng):
-                reglist.append(1)
-            for each in range(7 - rng):
-                reglist.append(0)
+            # the registers past the range are masked out
+            msk = (0xFF << (rng + 1)) & 0xFF
         else:
+            head = regs[0]
+            base = head.num
+            if base is None:
+                raise ValueError('invalid register: ' + head.text)
             reglist = [1, 0, 0, 0, 0, 0, 0, 0]
-            regs = operand[1:]
-            base = int(regs[0][1:])
             for each in regs[1:]:
-                if int(each[1:]) - base > 7 or int(each[1:]) - base < 0:
+                if each.num is None or each.num - base > 7 or each.num - base < 0:
                     raise ValueError('reglist is invalid')
                 else:
-                    reglist[(int(each[1:]) - base)] = 1
-        msk = 0b00000000
-        for i in range(8):
-            if reglist[i] == 0:
-                msk = msk | (0b1 << i)
-        operand = [operand[1], operand[0]]
-        return (0b01 << 23) + msk + self.parse_op_ldr(operand)
+                    reglist[(each.num - base)] = 1
+            msk = 0b00000000
+            for i in range(8):
+                if reglist[i] == 0:
+                    msk = msk | (0b1 << i)
+        return (0b01 << 23) + msk + self.layout_encoders['ldr']([head, operand[0]])
 
     def parse_op_pop(self, operand):
         if len(operand) != 1:
             raise ValueError('instruction operand length not equal to 1')
 
-        operand.append('[r31]')  # append [sp]
-        if '-' in operand[0]:
-            operand[0] = operand[0][:operand[0].find('-')]
-            return (0b1 << 24) + (0b01 << 23) + self.parse_op_ldr(operand)
+        stack = self.tokenize_operand('[r31]')  # [sp]
+        if '-' in operand[0].text:
+            head = self.register_list_head(operand[0])
+            return (0b1 << 24) + (0b01 << 23) + self.layout_encoders['ldr']([head, stack])
         else:
-            return (0b1 << 24) + self.parse_op_ldr(operand)
-
-    def parse_op_stro(self, operand):
-        return self.parse_op_ldro(operand)
-
-    def parse_op_str(self, operand):
-        return self.parse_op_ldr(operand)
-
-    def parse_op_strb(self, operand):
-        return self.parse_op_ldrb(operand)
-
-    def parse_op_strh(self, operand):
-        return self.parse_op_ldrh(operand)
-
-    def parse_op_strsb(self, operand):
-        return self.parse_op_ldrsb(operand)
-
-    def parse_op_strsh(self, operand):
-        return self.parse_op_ldrsh(operand)
+            return (0b1 << 24) + self.layout_encoders['ldr']([operand[0], stack])
 
     def parse_op_stm(self, operand):
-        if '-' in operand[1]:
-            regs = operand[1].split('-')
-            operand[1] = regs[0]
-        operand = [operand[1], operand[0]]
-        return (0b01 << 23) + self.parse_op_str(operand)
+        src = operand[1]
+        if '-' in src.text:
+            src = self.register_list_head(src)
+        return (0b01 << 23) + self.layout_encoders['ldr']([src, operand[0]])
 
     def parse_op_push(self, operand):
         if len(operand) != 1:
             raise ValueError('instruction operand length not equal to 1')
 
-        operand.append('[r31]')  # append [sp]
-        if '-' in operand[0]:
-            operand[0] = operand[0][:operand[0].find('-')]
-            return (0b1 << 24) + (0b01 << 23) + self.parse_op_str(operand)
+        stack = self.tokenize_operand('[r31]')  # [sp]
+        if '-' in operand[0].text:
+            head = self.register_list_head(operand[0])
+            return (0b1 << 24) + (0b01 << 23) + self.layout_encoders['ldr']([head, stack])
         else:
-            return (0b1 << 24) + self.parse_op_str(operand)
-
-    def parse_op_setr(self, operand):
-        if len(operand) != 3:
-            raise ValueError('instruction operands not equal to 3')
-
-        dst = operand[0]
-        mod = operand[1]
-        self.imm_validate(int(mod[1:]), 5, self.IMM_UNSIGNED)
-        src = operand[2]
-        self.imm_validate(int(src[1:]), 16, self.IMM_UNSIGNED)
-
-        imm = 0
-        imm += (int(dst[1:]) << 16)
-        imm += (int(mod[1:]) << 21)
-        imm += (int(src[1:]))
-
-        return imm
-
-    def parse_op_setrh(self, operand):
-        mod = '#3'  # 0b00011, only apply to 16 MSB, preserve the 16 LSB
-        operand.insert(1, mod)
-        return self.parse_op_setr(operand)
-
-    def parse_op_setrl(self, operand):
-        mod = '#12'  # 0b01100, only apply to 16 LSB, preserve the 16 MSB
-        operand.insert(1, mod)
-        return self.parse_op_setr(operand)
+            return (0b1 << 24) + self.layout_encoders['ldr']([operand[0], stack])
 
     def parse_op_setih(self, operand):
-        mod = '#1'  # only apply to 16 MSB, preserve the 16 LSB
+        mod = self.tokenize_operand('#1')  # only apply to 16 MSB, preserve the 16 LSB
         operand.insert(1, mod)
         return self.parse_op_seti(operand)
 
     def parse_op_setil(self, operand):
-        mod = '#0'  # only apply to 16 LSB, preserve the 16 MSB
+        mod = self.tokenize_operand('#0')  # only apply to 16 LSB, preserve the 16 MSB
         operand.insert(1, mod)
         return self.parse_op_seti(operand)
 
-    def parse_op_gopr(self, operand):
-        if len(operand) != 3:
-            raise ValueError('instruction operands not equal to 3')
-
-        mod = operand[0]
-        self.imm_validate(int(mod[1:]), 3, self.IMM_UNSIGNED)
-        dst = operand[1]
-        src = operand[2]
-
-        imm = 0
-        imm += (int(mod[1:]) << 21)
-        imm += (int(dst[1:]) << 16)
-
-        if '#' in src:
-            self.imm_validate(int(src[1:]), 16, self.IMM_BOTH)
-            imm += (0b1 << 24)
-            if '-' in src:
-                imm += (0x10000 - int(src[2:]))
-            else:
-                imm += int(src[1:])
-            if int(src[1:]) > 0x7FFF:
-                imm += (0b1 << 25)
-        else:
-            imm += (int(src[1:]) << 8)
-
-        return imm
-
-    def parse_op_add(self, operand):
-        return self.parse_op_gopr(operand)
-
-    def parse_op_sub(self, operand):
-        return self.parse_op_gopr(operand)
-
-    def parse_op_and(self, operand):
-        if len(operand) != 2:
-            raise ValueError('instruction operands not equal to 2')
-
-        dst = operand[0]
-        src = operand[1]
-
-        imm = 0
-        imm += (int(dst[1:]) << 16)
-
-        imm += (0b1 << 25)  # bit 25 reserved 1 for AND and ORR
-
-        if '#' in src:
-            self.imm_validate(int(src[1:]), 16, self.IMM_UNSIGNED)
-            imm += (0b1 << 24)
-            imm += int(src[1:])
-        else:
-            imm += (int(src[1:]) << 8)
-
-        return imm
-
-    def parse_op_not(self, operand):
-        if len(operand) != 2:
-            raise ValueError('instruction operands not equal to 2')
-
-        dst = operand[0]
-        src = operand[1]
-
-        imm = 0
-        imm += (int(dst[1:]) << 16)
-
-        if '#' in src:
-            self.imm_validate(int(src[1:]), 16, self.IMM_UNSIGNED)
-            imm += (0b1 << 24)
-            imm += int(src[1:])
-        else:
-            imm += (int(src[1:]) << 8)
-
-        return imm
-
-    def parse_op_orr(self, operand):
-        return self.parse_op_and(operand)
-
-    def parse_op_xor(self, operand):
-        return self.parse_op_not(operand)
-
-    def parse_op_lsr(self, operand):
-        if len(operand) != 2:
-            raise ValueError('instruction operands not equal to 2')
-
-        dst = operand[0]
-        src = operand[1]
-
-        imm = 0
-        imm += (int(dst[1:]) << 16)
-
-        if '#' in src:
-            self.imm_validate(int(src[1:]), 5, self.IMM_UNSIGNED)
-            imm += (0b1 << 24)
-            imm += int(src[1:])
-        else:
-            imm += (int(src[1:]) << 8)
-
-        return imm
-
-    def parse_op_asr(self, operand):
-        return (0b1 << 25) + self.parse_op_lsr(operand)
-
-    def parse_op_lsl(self, operand):
-        return self.parse_op_lsr(operand)
-
-    def parse_op_mul(self, operand):
-        if len(operand) != 2:
-            raise ValueError('instruction operands not equal to 2')
-
-        dst = operand[0]
-        src = operand[1]
-
-
-        imm = 0
-        imm += (int(dst[1:])<<16)
-
-        imm += (int(src[1:]) << 8)
-
-        return imm
-
-    def parse_op_mov(self, operand):
-        if len(operand) != 2:
-            raise ValueError('instruction operands not equal to 2')
-
-        dst = operand[0]
-        src = operand[1]
-
-        imm = 0
-        imm += (int(dst[1:]) << 16)
-
-        if '#' in src:
-            self.imm_validate(int(src[1:]), 16, self.IMM_BOTH)
-            imm += (0b1 << 24)
-            if '-' in src:
-                imm += (0x10000 - int(src[2:]))
-            else:
-                imm += int(src[1:])
-            if int(src[1:]) > 0x7FFF:
-                imm += (0b1 << 25)
-        else:
-            imm += (0b1 << 25)
-            imm += (int(src[1:]) << 8)
-
-        return imm
-
-    def parse_op_move(self, operand, cond):
-        if len(operand) != 2:
-            raise ValueError('instruction operands not equal to 2')
-
-        dst = operand[0]
-        src = operand[1]
-
-        imm = 0
-        imm += (cond << 21)
-
-        imm += (int(dst[1:]) << 16)
-
-        if '#' in src:
-            self.imm_validate(int(src[1:]), 16, self.IMM_BOTH)
-            imm += (0b1 << 24)
-            if '-' in src:
-                imm += (0x10000 - int(src[2:]))
-            else:
-                imm += int(src[1:])
-            if int(src[1:]) > 0x7FFF:
-                imm += (0b1 << 25)
-        else:
-            imm += (0b1 << 25)
-            imm += (int(src[1:]) << 8)
-
-        return imm
-
     def parse_op(self, op_code, operand, inst_label_list, index):
         """
         process the op code and operand
         """
-        code = 0
-        if op_code in self.instruction_dict:
-            code = (self.instruction_dict[op_code] << 26)
-
-        if op_code == 'jump':
-            code += self.parse_op_jump(operand)
-        if op_code == 'repeat':
-            code += self.parse_op_repeat(operand)
-        if op_code == 'wait':
-            code += self.parse_op_wait(operand)
-        if op_code == 'cmp':
-            code += self.parse_op_cmp(operand)
-        if op_code == 'b' or op_code == 'bl' or op_code == 'bx' or op_code == 'beq' or op_code == 'bgt' or op_code == 'blt' or op_code == 'bne' or op_code == 'ble' or op_code == 'bge':
-            cond = 0b110
-            if op_code == 'bgt':
-                cond = 0b000
-            if op_code == 'beq':
-                cond = 0b010
-            if op_code == 'blt':
-                cond = 0b100
-            if op_code == 'bne':
-                cond = 0b011
-            if op_code == 'ble':
-                cond = 0b001
-            if op_code == 'bge':
-                cond = 0b101
-
-            if op_code == 'bl':  # branch with LR updated
-                code += (0b1 << 22)
-            code += self.parse_op_b(operand, cond, inst_label_list, index)
-        if op_code == 'ldro':
-            code += self.parse_op_ldro(operand)
-        if op_code == 'ldr':
-            code += self.parse_op_ldr(operand)
-        if op_code == 'ldrb':
-            code += self.parse_op_ldrb(operand)
-        if op_code == 'ldrh':
-            code += self.parse_op_ldrh(operand)
-        if op_code == 'ldrsb':
-            code += self.parse_op_ldrsb(operand)
-        if op_code == 'ldrsh':
-            code += self.parse_op_ldrsh(operand)
-        if op_code == 'ldm':
-            code += self.parse_op_ldm(operand)
-        if op_code == 'pop':
-            code += self.parse_op_pop(operand)
-        if op_code == 'lea':
-            code += self.parse_op_lea(operand)
-        if op_code == 'str':
-            code += self.parse_op_str(operand)
-        if op_code == 'stro':
-            code += self.parse_op_stro(operand)
-        if op_code == 'strb':
-            code += self.parse_op_strb(operand)
-        if op_code == 'strh':
-            code += self.parse_op_strh(operand)
-        if op_code == 'strsb':
-            code += self.parse_op_strsb(operand)
-        if op_code == 'stm':
-            code += self.parse_op_stm(operand)
-        if op_code == 'strsh':
-            code += self.parse_op_strsh(operand)
-        if op_code == 'push':
-            code += self.parse_op_push(operand)
-        if op_code == 'setr':
-            code += self.parse_op_setr(operand)
-        if op_code == 'setrh':
-            code += self.parse_op_setrh(operand)
-        if op_code == 'setrl':
-            code += self.parse_op_setrl(operand)
-        if op_code == 'setih':
-            code += self.parse_op_setih(operand)
-        if op_code == 'setil':
-            code += self.parse_op_setil(operand)
-        if op_code == 'gopr':
-            code += self.parse_op_gopr(operand)
-        if op_code == 'add' or op_code == 'addm' or op_code == 'addl':
-            mod = ''
-            if op_code == 'addl':
-                mod = '#2'  # 0b010, only apply to 16 LSB
-            if op_code == 'addm':
-                mod = '#1'  # 0b001, only apply to 16 MSB
-            if op_code == 'add':
-                mod = '#0'  # 0b000, immediate with signed extended & apply to the word
-            operand.insert(0, mod)
-            code += self.parse_op_add(operand)
-        if op_code == 'sub' or op_code == 'subm' or op_code == 'subl':
-            mod = ''
-            if op_code == 'subl':
-                mod = '#6'  # 0b110, only apply to 16 LSB
-            if op_code == 'subm':
-                mod = '#5'  # 0b101, only apply to 16 MSB
-            if op_code == 'sub':
-                mod = '#4'  # 0b100, immediate with signed extended & apply to the word
-            operand.insert(0, mod)
-            code += self.parse_op_sub(operand)
-        if op_code == 'and' or op_code == 'andm' or op_code == 'andl':
-            if op_code == 'andl':
-                code += (0b10 << 21)  # only apply to 16 LSB
-            if op_code == 'andm':
-                code += (0b01 << 21)  # only apply to 16 MSB
-            if op_code == 'and':
-                code += (0b00 << 21)  # immediate with 0 extended & apply to the word
-            code += self.parse_op_and(operand)
-        if op_code == 'not' or op_code == 'notm' or op_code == 'notl':
-            if op_code == 'notl':
-                code += (0b10 << 21)  # only apply to 16 LSB
-            if op_code == 'notm':
-                code += (0b01 << 21)  # only apply to 16 MSB
-            if op_code == 'not':
-                code += (0b00 << 21)  # immediate with 0 extended & apply to the word
-            code += self.parse_op_not(operand)
-        if op_code == 'orr' or op_code == 'orrm' or op_code == 'orrl':
-            if op_code == 'orrl':
-                code += (0b10 << 21)  # only apply to 16 LSB
-            if op_code == 'orrm':
-                code += (0b01 << 21)  # only apply to 16 MSB
-            if op_code == 'orr':
-                code += (0b00 << 21)  # immediate with 0 extended & apply to the word
-            code += self.parse_op_orr(operand)
-        if op_code == 'xor' or op_code == 'xorm' or op_code == 'xorl':
-            if op_code == 'xorl':
-                code += (0b10 << 21)  # only apply to 16 LSB
-            if op_code == 'xorm':
-                code += (0b01 << 21)  # only apply to 16 MSB
-            if op_code == 'xor':
-                code += (0b00 << 21)  # immediate with 0 extended & apply to the word
-            code += self.parse_op_xor(operand)
-        if op_code == 'lsl':
-            code += self.parse_op_lsl(operand)
-        if op_code == 'lsr':
-            code += self.parse_op_lsr(operand)
-        if op_code == 'asr':
-            code += self.parse_op_asr(operand)
-        if op_code == 'mul' or op_code == 'muls' or op_code == 'mulsb' or op_code == 'mulb' or op_code == 'mulshl' or op_code == 'mulhl' or op_code == 'mulshm' or op_code == 'mulhm':
-            if op_code == 'mul':
-                code += (0b100 << 21)
-            if op_code == 'muls':
-                pass
-            if op_code == 'mulsb':
-                code += (0b010 << 21)
-            if op_code == 'mulb':
-                code += (0b110 << 21)
-            if op_code == 'mulshl':
-                code += (0b001 << 21)
-            if op_code == 'mulhl':
-                code += (0b101 << 21)
-            if op_code == 'mulshm':
-                code += (0b011 << 21)
-            if op_code == 'mulhm':
-                code += (0b111 << 21)
-            code += self.parse_op_mul(operand)
-        if op_code == 'mov' or op_code == 'movb' or op_code == 'movh' or op_code == 'movl':
-            if op_code == 'movb':
-                code += (0b10 << 21)  # only apply to 8 LSB
-            if op_code == 'movh':
-                code += (0b11 << 21)  # only apply to 16 MSB
-            if op_code == 'movl':
-                code += (0b01 << 21)  # only apply to 16 LSB
-            code += self.parse_op_mov(operand)
-        if op_code == 'cmov' or op_code == 'cmoveq' or op_code == 'cmovgt' or op_code == 'cmovlt' or op_code == 'cmovne' or op_code == 'cmovle' or op_code == 'cmovge':
-            cond = 0b110
-            if op_code == 'cmovgt':
-                cond = 0b000
-            if op_code == 'cmoveq':
-                cond = 0b010
-            if op_code == 'cmovlt':
-                cond = 0b100
-            if op_code == 'cmovne':
-                cond = 0b011
-            if op_code == 'cmovle':
-                cond = 0b001
-            if op_code == 'cmovge':
-                cond = 0b101
-            code += self.parse_op_move(operand, cond)
+        if op_code not in self.op_table:
+            return 0
+        encoder, code, kind = self.op_table[op_code]
 
-        return code
+        if kind == self.OP_PLAIN:
+            return code + encoder(operand)
+        return code + encoder(operand, inst_label_list, index)
 
     def parse_instruction(self, inst, inst_label_list, index):
         """
         convert to a 32 bit machine code
         """
-        operand = []
+        code_str = '0x{:08x}'.format(self.encode_instruction(inst, inst_label_list, index))
+        return code_str
+
+    def encode_instruction(self, inst, inst_label_list, index):
+        """
+        convert to a 32 bit machine code, as an int
+        the code of an instruction seen before is taken from the encode cache
+        """
+        # the cache is keyed on the normalized text, the same as it is stored
         inst = inst.replace('\t', ' ')
+        encode_cache = self.encode_cache
+        code = encode_cache.get(inst)
+        if code is not None:
+            self.encode_hits += 1
+            encode_cache.move_to_end(inst)
+            return code
+        self.encode_misses += 1
+
+        operand = []
         index_op = inst.find(' ')
         op_code = inst[:index_op]
         tmp_operand = inst[index_op:]
         items = tmp_operand.split(',')
 
+        self.check_op_code(op_code)
+
+        operand_records = self.operand_records
+        for each in items:
+            record = operand_records.get(each)
+            if record is None:
+                record = self.tokenize_operand(each)
+            operand.append(record)
+
+        code = self.encode_operands(op_code, operand, inst_label_list, index)
+        # a size of 0 or less turns the cache off, a size lowered on the fly evicts down to it
+        if op_code not in self.position_ops and self.encode_cache_size > 0:
+            while len(encode_cache) >= self.encode_cache_size:
+                encode_cache.popitem(last=False)
+            encode_cache[inst] = code
+        return code
+
+    def encode_cache_info(self):
+        """
+        hits, misses and size of the encode cache
+        """
+        return {'hits': self.encode_hits, 'misses': self.encode_misses,
+                'size': len(self.encode_cache), 'max_size': self.encode_cache_size}
+
+    def check_op_code(self, op_code):
         if op_code not in self.instruction_dict:
             if self.inst_extension:
                 if op_code not in self.inst_extension.instruction_dict:
@@ -2184,27 +2080,10 @@ class InstructionParser(object):
             else:
                 raise ValueError('instruction op code not exist: '+ op_code + '\n you may need to include an extension module')
 
-        for each in items:
-            each = (each.lstrip().rstrip())
-            each = each.replace('{', '')
-            each = each.replace('}', '')
-            if each == 'sp':
-                each = 'r31'
-            if each == 'lr':
-                each = 'r30'
-            if each == 'pc':
-                each = 'r29'
-            if each == 'st':
-                each = 'r28'
-            if each.startswith('#'):
-                if '0x' in each:
-                    tmp = int(each[1:], 16)
-                    each = '#' + str(tmp)
-                if '0b' in each:
-                    tmp = int(each[1:], 2)
-                    each = '#' + str(tmp)
-            operand.append(each)
-
+    def encode_operands(self, op_code, operand, inst_label_list, index):
+        """
+        convert an op code and its operand records to a 32 bit machine code, as an int
+        """
         try:
             if op_code in self.instruction_dict:
                 code = self.parse_op(op_code, operand, inst_label_list, index)
@@ -2213,60 +2092,133 @@ class InstructionParser(object):
                     code = self.inst_extension.parse_op(op_code, operand, inst_label_list, index)
                 else:
                     raise ValueError('the extension module was not loaded properly')
-        except:
-            raise ValueError('parse_op error with: '+op_code+', '+str(operand)+', '+str(index))
+        except Exception as e:
+            raise ValueError('parse_op error with: '+op_code+', '+str(operand)+', '+str(index)+' - '+str(e))
         
         if code >= 0x100000000:
             raise ValueError('parsed instruction code - '+str(code)+' is out of range: '+op_code+', '+str(operand)+', '+str(index))
-        
-        code_str = '0x{:08x}'.format(code)
-        return code_str
+
+        return code
+
+    def tokenize_operand(self, item):
+        """
+        the operand record of one comma separated item, or of an int immediate number, parsed once and then shared
+        """
+        record = self.operand_records.get(item)
+        if record is None:
+            if isinstance(item, int):
+                record = Imm('#' + str(item), item)
+            else:
+                record = parse_operand(item)
+            if len(self.operand_records) >= self.operand_cache_size:
+                self.operand_records.clear()
+            self.operand_records[item] = record
+        return record
 
     def strip_content(self, content):
         """
         strip out the unrelated content
         """
-        index_start = content.find('/*')
-        while index_start >= 0:
-            index_end = content.find('*/')
-            if index_end < 0:
-                raise ValueError('no matched */ found')
-            replace_str = content[index_start:index_end + 2]
-            content = content.replace(replace_str, '')
+        return ''.join(self.iter_stripped_lines(iter_text_lines(content)))
 
-            index_start = content.find('/*')
+    def iter_stripped_lines(self, lines):
+        """
+        strip out the unrelated content in a single pass over the lines, yielding the kept ones
+        """
+        pending = ''
+        in_comment = False
+        for line in lines:
+            # cut out /* */ blocks, the text around a block spanning lines is joined into one line
+            if in_comment or '/*' in line:
+                parts = [pending]
+                pos = 0
+                while True:
+                    if in_comment:
+                        index_end = line.find('*/', pos)
+                        if index_end < 0:
+                            break
+                        in_comment = False
+                        pos = index_end + 2
+                    else:
+                        index_start = line.find('/*', pos)
+                        if index_start < 0:
+                            parts.append(line[pos:])
+                            break
+                        parts.append(line[pos:index_start])
+                        in_comment = True
+                        pos = index_start + 2
+                pending = ''.join(parts)
+                if in_comment:
+                    continue
+                line = pending
+                pending = ''
 
-        buf = io.StringIO(content)
-        tmp_content = ''
-        line = buf.readline()
-        while line != '':
             tmp_line = line.lstrip()
 
             if '//' in tmp_line:
                 tmp_line = tmp_line[:tmp_line.find('//')] + '\n'
 
-            if tmp_line.startswith('.'):
-                tmp_content += ''
-            else:
-                if tmp_line != '' and tmp_line != '\n':
-                    tmp_content += tmp_line
-            line = buf.readline()
+            if tmp_line.startswith('.') or tmp_line == '' or tmp_line == '\n':
+                continue
+            yield tmp_line
 
-        return tmp_content
+        if in_comment:
+            raise ValueError('no matched */ found')
 
-    def merge_instruction(self, inst_list):
+    def iter_instructions(self, lines):
         """
-        merge the consecutive instructions into a single one if applicable
+        split the stripped lines into (instruction, label) records
         """
-        instruction_list = InstFuncLabel()
+        label = ''
+        for line in lines:
+            tmp_line = line.lstrip()
+            tmp_line = tmp_line.rstrip()
+            # function or label
+            if tmp_line.endswith(':'):
+                label = tmp_line[0:-1]
+                if ' ' in label:
+                    raise ValueError('invalid label with space in "' + label + '"')
+            else:
+                # change to lower case
+                tmp_line = tmp_line.lower()
+                yield tmp_line, label
+                label = ''
+
+    def iter_validated(self, records):
+        """
+        pass the records through, and fail at the end of the stream if any label is duplicated
+        """
+        labels = set()
+        duplicated = []
+        for inst, label in records:
+            if label:
+                if label in labels:
+                    duplicated.append(label)
+                else:
+                    labels.add(label)
+            yield inst, label
 
-        index = 0
-        while index < inst_list.length():
-            inst = inst_list.list_inst[index]
-            label = inst_list.list_label[index]
+        if duplicated:
+            raise ValueError('invalid instruction set, found duplicated labels: ' + str(duplicated))
 
-            # operand = []
+    def iter_merged(self, records):
+        """
+        merge the consecutive records into a single one if applicable
+        """
+        head = None
+        head_label = ''
+        for inst, label in records:
             inst = inst.replace('\t', ' ')
+
+            if head is not None:
+                tmp_index_op = inst.find(' ')
+                tmp_op_code = inst[:tmp_index_op]
+                tmp_operand = inst[tmp_index_op:]
+                if self.inst_extension.merge_into(head, tmp_op_code, tmp_operand):
+                    continue
+                yield head.op_code + ' ' + head.operand(), head_label
+                head = None
+
             index_op = inst.find(' ')
             if index_op < 0:
                 op_code = inst
@@ -2275,144 +2227,1221 @@ class InstructionParser(object):
                 op_code = inst[:index_op]
                 operand = inst[index_op:]
 
-            tmp_index = index
-            if self.inst_extension:
-                if op_code in self.inst_extension.instruction_dict_merge:
-                    tmp_index = index + 1
-                    while tmp_index < inst_list.length():
-                        tmp_inst = inst_list.list_inst[tmp_index]
-                        tmp_inst = tmp_inst.replace('\t', ' ')
-                        tmp_index_op = tmp_inst.find(' ')
-                        tmp_op_code = tmp_inst[:tmp_index_op]
-                        tmp_operand = tmp_inst[tmp_index_op:]
-                        if self.inst_extension.merge(op_code, operand, tmp_op_code, tmp_operand):
-                            operand += (',' + tmp_operand)
-                            tmp_index += 1
-                        else:
-                            break
-                else:
-                    tmp_index += 1
+            if self.inst_extension and op_code in self.inst_extension.instruction_dict_merge:
+                head = self.inst_extension.merge_group(op_code, operand)
+                head_label = label
             else:
-                tmp_index += 1
+                yield op_code + ' ' + operand, label
+
+        if head is not None:
+            yield head.op_code + ' ' + head.operand(), head_label
+
+    def iter_encoded(self, records, inst_label_list, index=0):
+        """
+        convert the merged records into (instruction, label, machine code) records
+        index is the position of the first record in the whole stream
+        """
+        for inst, label in records:
+            yield inst, label, self.encode_instruction(inst, inst_label_list, index)
+            index += 1
+
+    def stage(self, name, items):
+        """
+        the items of a pipeline stage, timed under name when profiling
+        """
+        if self.profile is None:
+            return items
+        return self.profile.stage(name, items)
+
+    def timed(self, name, func, *args):
+        """
+        func(*args), timed under name when profiling
+        """
+        if self.profile is None:
+            return func(*args)
+        return self.profile.call(name, func, *args)
+
+    def collect_labels(self, lines):
+        """
+        first pass over the stripped lines: validate them and find the label positions after merging
+        """
+        label_table = LabelTable()
+        records = self.iter_validated(self.iter_instructions(lines))
+        for inst, label in self.iter_merged(records):
+            label_table.add(label)
+
+        return label_table
+
+    def emit_instructions(self, encoded, hex_file, c_file, h_file, words=None):
+        """
+        write the encoded records out as they come, and collect the codes into words if given
+        """
+        # the first '};' of a file has no array to close
+        block_end = '\n\n'
+        for inst, label, code in encoded:
+            code_str = '0x{:08x}'.format(code)
+            if words is not None:
+                words.append(code)
+            if label.startswith('__'):
+                if c_file:
+                    c_file.write('                 // ' + label + ':\n')
+            elif label != '':
+                if c_file:
+                    c_file.write(block_end + 'const uint32_t ' + label + '[] = {\n')
+                block_end = '};\n\n'
+                # save into the .h file
+                if h_file:
+                    h_file.write('extern const uint32_t ' + label + '[];\n')
+
+            # save into the .c file
+            if c_file:
+                c_file.write('    ' + code_str + ',' + '  //     ' + inst + '\n')
+            # save into the hex file
+            if hex_file:
+                hex_file.write(code_str[2:] + '\n')
 
-            inst = op_code + ' ' + operand
-            instruction_list.add(inst, label)
-            index = tmp_index
+        if c_file:
+            c_file.write(block_end)
+
+    def merge_instruction(self, inst_list):
+        """
+        merge the consecutive instructions into a single one if applicable, in place
+        """
+        inst_list.replace(self.iter_merged(inst_list.iter_records()))
 
-        return instruction_list
+        return inst_list
 
     def validate_instruction(self, inst_list):
-        label_list = inst_list.list_label
-        # print(label_list)
-        stripped_list = list(filter(None, label_list))
-        # print(stripped_list)
-        no_duplicated_list = list(set(stripped_list))
-        # print(no_duplicated_list)
-
-        if len(stripped_list) != len(no_duplicated_list):
-            for each in no_duplicated_list:
-                stripped_list.remove(each)
-
-            print('********************************')
-            print("found duplicated labels: " + str(stripped_list))
-            print('********************************\n')
+        try:
+            for each in self.iter_validated(inst_list.iter_records()):
+                pass
+        except ValueError:
             return False
 
         return True
 
+    def lines_to_instruction(self, open_lines, hex_file, c_file, h_file, words=None, strip=True):
+        """
+        convert the source lines to detailed instruction as a stream
+        open_lines() returns a fresh iterator over the lines, it is called once per pass
+        """
+        def open_stripped(timed):
+            lines = open_lines()
+            if timed:
+                lines = self.stage('read', lines)
+            if strip:
+                lines = self.iter_stripped_lines(lines)
+                if timed:
+                    lines = self.stage('strip', lines)
+            return lines
+
+        # the label positions are needed before any branch can be encoded
+        # the first pass is timed as a whole as 'labels', the other stages only time the second pass
+        label_table = self.timed('labels', self.collect_labels, open_stripped(False))
+
+        records = self.stage('split', self.iter_instructions(open_stripped(True)))
+        records = self.stage('merge', self.iter_merged(records))
+        encoded = self.stage('parse', self.iter_encoded(records, label_table))
+        self.timed('emit', self.emit_instructions, encoded, hex_file, c_file, h_file, words)
+
+        return label_table
+
+    def file_to_instruction(self, file_path, hex_file, c_file, h_file, words=None):
+        """
+        convert a source file to detailed instruction, reading it line by line
+        """
+        if self.profile is not None:
+            self.profile.start_file(file_path)
+        self.lines_to_instruction(lambda: iter_file_lines(file_path), hex_file, c_file, h_file, words)
+        if self.profile is not None:
+            self.profile.end_file()
+
+    def file_to_fragments(self, file_path):
+        """
+        convert a source file into its output fragments: {'words': [codes], 'c': .c text, 'h': .h text}
+        """
+        c_file = io.StringIO()
+        h_file = io.StringIO()
+        words = []
+        self.file_to_instruction(file_path, None, c_file, h_file, words)
+
+        return {'words': words, 'c': c_file.getvalue(), 'h': h_file.getvalue()}
+
+    def file_to_object(self, file_path):
+        """
+        convert a source file into a relocatable object:
+        {'words': [codes], 'insts': [instruction texts], 'labels': {position: label},
+         'symbols': {label: position}, 'relocations': [[position, label]]}
+        the labels not starting with '__' are the symbols other objects can branch to
+        """
+        def open_stripped():
+            return self.stage('strip', self.iter_stripped_lines(self.stage('read', iter_file_lines(file_path))))
+
+        if self.profile is not None:
+            self.profile.start_file(file_path)
+        # the first pass is timed as a whole as 'labels', like in lines_to_instruction
+        object_labels = ObjectLabels(self.timed('labels', self.collect_labels,
+                                                self.iter_stripped_lines(iter_file_lines(file_path))))
+        words = []
+        insts = []
+        labels = {}
+        records = self.stage('merge', self.iter_merged(self.stage('split', self.iter_instructions(open_stripped()))))
+        for index, (inst, label) in enumerate(records):
+            object_labels.index = index
+            words.append(self.encode_instruction(inst, object_labels, index))
+            insts.append(inst)
+            if label:
+                labels[index] = label
+        if self.profile is not None:
+            self.profile.end_file()
+
+        symbols = {label: pos for label, pos in object_labels.label_table.label_pos.items() if not label.startswith('__')}
+        return {'words': words, 'insts': insts, 'labels': labels, 'symbols': symbols,
+                'relocations': object_labels.relocations}
+
+    def assemble(self, source, c=False, h=False):
+        """
+        assemble source text in memory, without any file or console output
+        the .c / .h text is only generated when asked for, without the prefix_* / suffix_* content
+        """
+        words = array('I')
+        c_file = io.StringIO() if c else None
+        h_file = io.StringIO() if h else None
+        label_table = self.lines_to_instruction(lambda: iter_text_lines(source), None, c_file, h_file, words)
+
+        return AssemblyResult(words, label_table.label_pos,
+                              c_file.getvalue() if c else None,
+                              h_file.getvalue() if h else None)
 
     def syntax_to_instruction(self, content, hex_file, c_file, h_file):
         """
         convert the syntax to detailed instruction 
         """
-        buf = io.StringIO(content)
-        tmp_content = ''
-        instruction_list = InstFuncLabel()
+        self.lines_to_instruction(lambda: iter_text_lines(content), hex_file, c_file, h_file, strip=False)
+
+
+class AssemblyResult(object):
+    """
+    output of an in-memory assembly
+    words: array('I') of the machine codes
+    labels: label -> index of its word, functions: the same for the labels that start a C array
+    c / h: the .c / .h text, None if not asked for
+    """
+    def __init__(self, words, labels, c=None, h=None):
+        self.words = words
+        self.labels = labels
+        self.functions = {label: pos for label, pos in labels.items() if not label.startswith('__')}
+        self.c = c
+        self.h = h
+
+
+# extension loaded or not -> parser shared by the assemble() calls
+shared_parsers = {}
+
+
+def assemble(source, c=False, h=False, extension=True):
+    """
+    assemble source text in memory, e.g. assemble('main:\n    add r1, #1\n').words
+    the parser is built on the first call and reused by the later ones
+    """
+    inst_parser = shared_parsers.get(extension)
+    if inst_parser is None:
+        inst_parser = InstructionParser(extension)
+        shared_parsers[extension] = inst_parser
+    return inst_parser.assemble(source, c, h)
+
+
+class InstructionBuilder(object):
+    """
+    builds a program from python values and encodes it without going through source text
+        b = InstructionBuilder()
+        b.label('main')
+        b.add('r1', 5)             # add r1, #5
+        b.dstm0('master0', enable='constant')
+        b.b('main')
+        result = b.build()         # an AssemblyResult, as from assemble()
+    there is a method per op code, with a trailing '_' for the python keywords: b.and_('r1', 1)
+    ints are immediate numbers, strings are operands as written in the source, keywords are key=value
+    parameters with '_' in the key standing for '-'
+    """
+    def __init__(self, inst_parser=None):
+        if inst_parser is None:
+            inst_parser = shared_parsers.get(True)
+            if inst_parser is None:
+                inst_parser = InstructionParser(True)
+                shared_parsers[True] = inst_parser
+        self.inst_parser = inst_parser
+        self.op_codes = set(inst_parser.instruction_dict)
+        if inst_parser.inst_extension:
+            self.op_codes.update(inst_parser.inst_extension.instruction_dict)
+        # [op code, operand records, label] per instruction
+        self.instructions = []
+        self.labels = set()
+        self.next_label = ''
+
+    def label(self, name):
+        """
+        label the next instruction, the last label wins if several are given in a row
+        build() fails if no instruction comes after it
+        """
+        if ' ' in name:
+            raise ValueError('invalid label with space in "' + name + '"')
+        self.next_label = name
+        return self
 
-        line = buf.readline()
-        label = ''
-        while line != '':
+    def emit(self, op_code, *args, **kwargs):
+        """
+        append one instruction
+        """
+        if op_code not in self.op_codes:
+            self.inst_parser.check_op_code(op_code)
+        operand_records = self.inst_parser.operand_records
+        tokenize_operand = self.inst_parser.tokenize_operand
+        operand = []
+        for each in args:
+            record = operand_records.get(each)
+            if record is None:
+                if isinstance(each, Operand):
+                    record = each
+                elif isinstance(each, (int, str)):
+                    record = tokenize_operand(each)
+                else:
+                    raise ValueError('unsupported operand: ' + repr(each))
+            operand.append(record)
+        for key, val in kwargs.items():
+            operand.append(tokenize_operand(key.replace('_', '-') + '=' + str(val)))
+
+        label = self.next_label
+        if label:
+            if label in self.labels:
+                raise ValueError('invalid instruction set, found duplicated labels: ' + str([label]))
+            self.labels.add(label)
+            self.next_label = ''
+        self.instructions.append([op_code, operand, label])
+        return self
+
+    def iter_merged(self):
+        """
+        merge the consecutive instructions as the source text would be, a label on a merged one is dropped
+        """
+        inst_extension = self.inst_parser.inst_extension
+        head = None
+        for op_code, operand, label in self.instructions:
+            if head is not None:
+                if inst_extension.merge_into(group, op_code, operand_text(operand)):
+                    head[1].extend(operand)
+                    continue
+                yield head
+                head = None
+
+            if inst_extension and op_code in inst_extension.instruction_dict_merge:
+                group = inst_extension.merge_group(op_code, operand_text(operand))
+                head = [op_code, list(operand), label]
+            else:
+                yield op_code, operand, label
 
-            tmp_line = line.lstrip()
-            tmp_line = tmp_line.rstrip()
-            # function or label
-            if tmp_line.endswith(':'):
-                label = tmp_line[0:-1]
-                if ' ' in label:
-                    raise ValueError('invalid label with space in "' + label + '"')
+        if head is not None:
+            yield head
+
+    def build(self, c=False, h=False):
+        """
+        encode the instructions appended so far, returns an AssemblyResult
+        """
+        if self.next_label:
+            raise ValueError('label "' + self.next_label + '" has no instruction after it')
+        inst_parser = self.inst_parser
+        merged = list(self.iter_merged())
+        label_table = LabelTable()
+        for op_code, operand, label in merged:
+            label_table.add(label)
+
+        def iter_encoded():
+            for index, (op_code, operand, label) in enumerate(merged):
+                code = inst_parser.encode_operands(op_code, list(operand), label_table, index)
+                # the .c comment shows the instruction as an instruction line, with the operands normalized
+                inst = op_code + ' ' + operand_text(operand) if c else ''
+                yield inst, label, code
+
+        words = array('I')
+        c_file = io.StringIO() if c else None
+        h_file = io.StringIO() if h else None
+        inst_parser.emit_instructions(iter_encoded(), None, c_file, h_file, words)
+
+        return AssemblyResult(words, label_table.label_pos,
+                              c_file.getvalue() if c else None,
+                              h_file.getvalue() if h else None)
+
+
+def operand_text(operand):
+    """
+    the operand records written back as in an instruction line, after its op code
+    """
+    return ' ' + ', '.join([each.text for each in operand])
+
+
+def builder_method(op_code):
+    def emit(self, *args, **kwargs):
+        return self.emit(op_code, *args, **kwargs)
+    emit.__name__ = op_code
+    emit.__doc__ = 'append a ' + op_code + ' instruction'
+    return emit
+
+
+def add_builder_methods():
+    """
+    a method per op code, with a trailing '_' for the python keywords
+    """
+    for op_code in list(InstructionParser.instruction_dict) + list(InstructionExtension.instruction_dict):
+        name = op_code + '_' if keyword.iskeyword(op_code) else op_code
+        setattr(InstructionBuilder, name, builder_method(op_code))
+
+
+add_builder_methods()
+
+
+def assembler_version(inst_parser):
+    """
+    the assembler source itself is the version, plus whether the extension module is loaded
+    """
+    import hashlib
+    digest = hashlib.sha256()
+    with open(os.path.abspath(__file__), 'rb') as f:
+        digest.update(f.read())
+    if inst_parser.inst_extension:
+        digest.update(b'extension')
+    return digest.hexdigest()
+
+
+class AssemblyCache(object):
+    """
+    on-disk cache of the per-file output fragments
+    an entry is keyed by the file content and the version of the assembler that produced it
+    """
+    def __init__(self, cache_dir, inst_parser):
+        self.cache_dir = os.path.abspath(cache_dir)
+        os.makedirs(self.cache_dir, exist_ok=True)
+        self.version = assembler_version(inst_parser)
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, content):
+        import hashlib
+        digest = hashlib.sha256(self.version.encode())
+        digest.update(content)
+        return digest.hexdigest()
+
+    def load(self, key):
+        cache_path = os.path.join(self.cache_dir, key + '.json')
+        try:
+            with open(cache_path, 'r') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def store(self, key, fragments):
+        # write to a temporary file first so that a concurrent reader never sees a partial entry
+        cache_path = os.path.join(self.cache_dir, key + '.json')
+        tmp_path = cache_path + '.' + str(os.getpid()) + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(fragments, f)
+        os.replace(tmp_path, cache_path)
+
+    def file_key(self, file_path):
+        with open(os.path.abspath(file_path), 'rb') as f:
+            return self.key(f.read())
+
+    def lookup(self, key):
+        fragments = self.load(key)
+        if fragments is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return fragments
+
+
+def file_stamp(file_path):
+    """
+    what tells that a file changed: its modification time and size, None if it does not exist
+    """
+    try:
+        stat = os.stat(file_path)
+    except OSError:
+        return None
+    return (stat.st_mtime_ns, stat.st_size)
+
+
+def inst_op_code(inst):
+    inst = inst.replace('\t', ' ')
+    index_op = inst.find(' ')
+    if index_op < 0:
+        return inst
+    return inst[:index_op]
+
+
+class FunctionFragment(object):
+    """
+    output of one function of an incrementally assembled file
+    refs: label -> position relative to the function start, of every label the branches of the function use
+    """
+    def __init__(self, words, c, h, refs):
+        self.words = words
+        self.c = c
+        self.h = h
+        self.refs = refs
+
+    def reusable(self, label_pos, start):
+        # branches are relative, the code holds as long as every label used is at the same distance
+        for label, offset in self.refs.items():
+            pos = label_pos.get(label)
+            if pos is None or pos - start != offset:
+                return False
+        return True
+
+
+class IncrementalFile(object):
+    """
+    a source file kept assembled function by function, an edit only encodes again the functions it touched
+    the file is cut before every label line that starts a C array; the records of each piece and the output of
+    each function are kept by their text, until a later update no longer has them
+    """
+    def __init__(self, inst_parser, file_path):
+        self.inst_parser = inst_parser
+        self.file_path = file_path
+        self.stamp = None
+        self.fragments = None
+        # texts of the instructions of every store below
+        self.text_table = TextTable()
+        # chunk text -> (split records, merged records), as InstFuncLabel
+        self.chunks = {}
+        # texts of the chunks of a function -> FunctionFragment
+        self.functions = {}
+        # functions encoded and reused by the last update
+        self.encoded = 0
+        self.reused = 0
+
+    def split_chunks(self, lines):
+        """
+        the text of the file cut before every line holding a label that starts a C array
+        a line inside or around a /* */ comment never starts a chunk
+        """
+        chunks = []
+        current = []
+        in_comment = False
+        for line in lines:
+            if in_comment or '/*' in line:
+                pos = 0
+                while True:
+                    if in_comment:
+                        index_end = line.find('*/', pos)
+                        if index_end < 0:
+                            break
+                        in_comment = False
+                        pos = index_end + 2
+                    else:
+                        index_start = line.find('/*', pos)
+                        if index_start < 0:
+                            break
+                        in_comment = True
+                        pos = index_start + 2
             else:
-                # change to lower case
-                tmp_line = tmp_line.lower()
-                instruction_list.add(tmp_line, label)
-                label = ''
+                text = line.strip()
+                if '//' in text:
+                    text = text[:text.find('//')].rstrip()
+                if text.endswith(':') and not text.startswith('__') and current:
+                    chunks.append(''.join(current))
+                    current = []
+            current.append(line)
+        if current:
+            chunks.append(''.join(current))
+
+        return chunks
+
+    def chunk_records(self, text):
+        inst_parser = self.inst_parser
+        records = self.chunks.get(text)
+        if records is None:
+            split = InstFuncLabel(self.text_table)
+            split.extend(inst_parser.iter_instructions(inst_parser.iter_stripped_lines(iter_text_lines(text))))
+            try:
+                merged = InstFuncLabel(self.text_table).extend(inst_parser.iter_merged(split.iter_records()))
+            except ValueError:
+                # e.g. an ares group started by the chunk before, known once the chunks are grouped
+                merged = None
+            records = (split, merged)
+        return records
+
+    def split_functions(self, chunks):
+        """
+        group the chunks into functions: [chunk texts, split records, merged records], records as InstFuncLabel lists
+        a chunk stays with the one before it if it does not start a C array or a merge group may span the two
+        """
+        inst_parser = self.inst_parser
+        merge_ops = inst_parser.inst_extension.instruction_dict_merge if inst_parser.inst_extension else {}
+        chunk_records = {}
+        functions = []
+        for text in chunks:
+            split, merged = chunk_records[text] = self.chunk_records(text)
+            if not split.size:
+                continue
+            if functions and inst_op_code(split.inst(0)) in merge_ops:
+                last = functions[-1][1][-1]
+                if inst_op_code(split.inst(0)) == inst_op_code(last.inst(last.size - 1)):
+                    function = functions[-1]
+                    function[0].append(text)
+                    function[1].append(split)
+                    records = itertools.chain.from_iterable(each.iter_records() for each in function[1])
+                    function[2] = [InstFuncLabel(self.text_table).extend(inst_parser.iter_merged(records))]
+                    continue
+            if merged is None:
+                # raise the error of the chunk on its own
+                merged = InstFuncLabel(self.text_table).extend(inst_parser.iter_merged(split.iter_records()))
+            label = merged.label(0)
+            if functions and (label == '' or label.startswith('__')):
+                function = functions[-1]
+                function[0].append(text)
+                function[1].append(split)
+                function[2].append(merged)
+            else:
+                functions.append([[text], [split], [merged]])
+        self.chunks = chunk_records
 
-            line = buf.readline()
+        return functions
 
-        # check the validity of instructions
-        if not self.validate_instruction(instruction_list):
-            raise ValueError('invalid instruction set')
+    def update(self):
+        """
+        the output fragments of the file like file_to_fragments, with the words as an array('I')
+        the file is only assembled again if it changed
+        """
+        stamp = file_stamp(self.file_path)
+        if stamp is not None and stamp == self.stamp:
+            self.encoded = 0
+            self.reused = 0
+            return self.fragments
+
+        with open(os.path.abspath(self.file_path), 'r') as f:
+            functions = self.split_functions(self.split_chunks(f))
+
+        # the same checks as the full assembly, over the whole file, they only need the labels
+        for each in self.inst_parser.iter_validated(('', label) for function in functions
+                                                    for split in function[1] for label in split.labels.values()):
+            pass
+        label_table = LabelTable()
+        for function in functions:
+            for merged in function[2]:
+                label_table.add_labels(merged.labels, merged.size)
+
+        inst_parser = self.inst_parser
+        fragments_by_text = {}
+        fragments = []
+        encoded = 0
+        start = 0
+        for texts, splits, merged in functions:
+            key = tuple(texts)
+            fragment = self.functions.get(key)
+            if fragment is None or not fragment.reusable(label_table.label_pos, start):
+                function_labels = FunctionLabels(label_table, start)
+                words = array('I')
+                c_file = io.StringIO()
+                h_file = io.StringIO()
+                records = itertools.chain.from_iterable(each.iter_records() for each in merged)
+                inst_parser.emit_instructions(inst_parser.iter_encoded(records, function_labels, start),
+                                              None, c_file, h_file, words)
+                fragment = FunctionFragment(words, c_file.getvalue(), h_file.getvalue(), function_labels.refs)
+                encoded += 1
+            fragments_by_text[key] = fragment
+            fragments.append(fragment)
+            start += sum(each.size for each in merged)
+
+        words = array('I')
+        for fragment in fragments:
+            words.extend(fragment.words)
+        if fragments:
+            # every function after the first one opens a C array, the array before it is already closed
+            c = fragments[0].c + ''.join(fragment.c[2:] for fragment in fragments[1:])
+        else:
+            c = '\n\n'
 
-        # merge the consecutive ones
-        instruction_list = self.merge_instruction(instruction_list)
+        self.functions = fragments_by_text
+        self.encoded = encoded
+        self.reused = len(fragments) - encoded
+        self.stamp = stamp
+        self.fragments = {'words': words, 'c': c, 'h': ''.join(fragment.h for fragment in fragments)}
+        return self.fragments
 
-        for i in range(instruction_list.length()):
-            inst = instruction_list.list_inst[i]
-            label = instruction_list.list_label[i]
-            if label.startswith('__'):
-                tmp_content += '                 // ' + label + ':\n'
-            elif label != '':
-                tmp_content += ('};\n\n')
-                tmp_content += ('const uint32_t ' + label + '[] = {\n')
-                # save into the .h file
-                if h_file:
-                    h_file.write('extern const uint32_t ' + label + '[];\n')
 
-            code_str = self.parse_instruction(inst, instruction_list, i)
-            tmp_content += ('    ' + code_str + ',' + '  //     ' + inst + '\n')
-            # save into the hex file
-            if hex_file:
-                hex_file.write(code_str[2:] + '\n')
+class Profile(object):
+    """
+    wall time spent in each stage of the assembly, per input file and in total
+    a stage only counts its own work, the time of the stages feeding it is taken off
+    'labels' is the whole first pass, which reads and splits the lines once more, the other stages are the second pass
+    """
+    stages = ['labels', 'read', 'strip', 'split', 'merge', 'parse', 'emit']
 
-        tmp_content += ('};\n\n')
+    def __init__(self):
+        self.files = []
+        self.current = None
+        # time spent in the nested stages of every stage currently running
+        self.nested = [0.0]
+        # stages timed outside of any input file, e.g. writing the output files
+        self.extra = {}
+
+    def start_file(self, file_path, size=None):
+        if size is None:
+            size = os.path.getsize(file_path)
+        self.current = {'file': file_path, 'bytes': size, 'times': {}, 'items': {}, 'start': time.perf_counter()}
+        self.files.append(self.current)
+
+    def end_file(self):
+        self.current['seconds'] = time.perf_counter() - self.current.pop('start')
+        self.current = None
+
+    def record(self):
+        # stages run outside of file_to_instruction are put under one anonymous input
+        if self.current is None:
+            self.start_file('<input>', 0)
+        return self.current
+
+    def stage(self, name, items):
+        """
+        pass the items through, timing how long each one takes to produce
+        """
+        record = self.record()
+        times = record['times']
+        counts = record['items']
+        nested = self.nested
+        items = iter(items)
+        while True:
+            nested.append(0.0)
+            start = time.perf_counter()
+            try:
+                item = next(items)
+            except StopIteration:
+                return
+            finally:
+                elapsed = time.perf_counter() - start
+                times[name] = times.get(name, 0.0) + elapsed - nested.pop()
+                nested[-1] += elapsed
+            counts[name] = counts.get(name, 0) + 1
+            yield item
+
+    def call(self, name, func, *args):
+        """
+        func(*args), timed as a stage
+        """
+        times = self.record()['times']
+        nested = self.nested
+        nested.append(0.0)
+        start = time.perf_counter()
+        try:
+            return func(*args)
+        finally:
+            elapsed = time.perf_counter() - start
+            times[name] = times.get(name, 0.0) + elapsed - nested.pop()
+            nested[-1] += elapsed
 
-        tmp_content = tmp_content.replace('};', '', 1)
-        # save into the .c file
-        if c_file:
-            c_file.write(tmp_content)
+    def add(self, name, seconds):
+        self.extra[name] = self.extra.get(name, 0.0) + seconds
+
+    def summary(self, name, size, instructions, times, seconds):
+        """
+        seconds, instructions/second and bytes/second of every stage, plus 'all' for the whole
+        """
+        stages = {}
+        for stage in self.stages + sorted(set(times) - set(self.stages)) + ['all']:
+            elapsed = seconds if stage == 'all' else times.get(stage)
+            if elapsed is None:
+                continue
+            stages[stage] = {
+                'seconds': elapsed,
+                'instructions_per_second': instructions / elapsed if elapsed > 0 else 0.0,
+                'bytes_per_second': size / elapsed if elapsed > 0 else 0.0,
+            }
+        return {'file': name, 'bytes': size, 'instructions': instructions, 'stages': stages}
+
+    def to_json(self):
+        files = []
+        total_times = dict(self.extra)
+        total_seconds = sum(self.extra.values())
+        for each in self.files:
+            # an input not read by file_to_instruction has no wall time of its own
+            seconds = each.get('seconds', sum(each['times'].values()))
+            total_seconds += seconds
+            files.append(self.summary(each['file'], each['bytes'], each['items'].get('parse', 0),
+                                      each['times'], seconds))
+            for stage, elapsed in each['times'].items():
+                total_times[stage] = total_times.get(stage, 0.0) + elapsed
+        total = self.summary('total', sum(each['bytes'] for each in files),
+                             sum(each['instructions'] for each in files), total_times, total_seconds)
+        return {'files': files, 'total': total}
+
+    def report(self):
+        """
+        the profile as a text table
+        """
+        data = self.to_json()
+        lines = ['%-32s %-9s %12s %14s %12s' % ('file', 'stage', 'seconds', 'inst/s', 'MB/s')]
+        for each in data['files'] + [data['total']]:
+            for stage, values in each['stages'].items():
+                lines.append('%-32s %-9s %12.6f %14.0f %12.2f' % (each['file'], stage, values['seconds'],
+                                                                   values['instructions_per_second'],
+                                                                   values['bytes_per_second'] / 1e6))
+        return '\n'.join(lines) + '\n'
+
+
+# parser of a worker process, inherited from the parent when the pool forks
+worker_parser = None
+
+
+def init_worker(extension):
+    global worker_parser
+    if worker_parser is None:
+        worker_parser = InstructionParser(extension)
+
+
+def assemble_worker(file_path):
+    return worker_parser.file_to_fragments(file_path)
+
+
+def assemble_files(inst_parser, inputs, jobs=1, cache=None):
+    """
+    the output fragments of every input file, in input order
+    files are looked up in the cache first, the rest are assembled across jobs processes
+    """
+    global worker_parser
+
+    fragments_list = [None] * len(inputs)
+    keys = [None] * len(inputs)
+    pending = []
+    for i, each in enumerate(inputs):
+        if cache:
+            keys[i] = cache.file_key(each)
+            fragments_list[i] = cache.lookup(keys[i])
+        if fragments_list[i] is None:
+            pending.append(i)
+
+    if jobs > 1 and len(pending) > 1:
+        # imported here, it takes longer to import than a small file takes to assemble
+        from concurrent.futures import ProcessPoolExecutor
+
+        worker_parser = inst_parser
+        with ProcessPoolExecutor(max_workers=min(jobs, len(pending)), initializer=init_worker,
+                                 initargs=(inst_parser.inst_extension is not None,)) as pool:
+            results = pool.map(assemble_worker, [inputs[i] for i in pending])
+            for i, fragments in zip(pending, results):
+                fragments_list[i] = fragments
+    else:
+        for i in pending:
+            fragments_list[i] = inst_parser.file_to_fragments(inputs[i])
+
+    if cache:
+        for i in pending:
+            cache.store(keys[i], fragments_list[i])
+
+    return fragments_list
+
+
+# kind and version of the relocatable object files
+object_format = 'luna-object'
+object_format_version = 1
+
+
+def object_path(source_path, output=None):
+    if output is not None:
+        return output + '.lo'
+    return os.path.splitext(source_path)[0] + '.lo'
+
+
+def read_object(file_path):
+    with open(file_path, 'r') as f:
+        obj = json.load(f)
+    if obj.get('format') != object_format or obj.get('format_version') != object_format_version:
+        raise ValueError('not a luna object file: ' + file_path)
+    # json keys are text
+    obj['labels'] = {int(pos): label for pos, label in obj['labels'].items()}
+    return obj
+
+
+def write_objects(inst_parser, inputs, output=None):
+    """
+    write the relocatable object of every input, next to it or at output.lo for a single input
+    an object newer than its source and written by the same assembler is kept as it is
+    """
+    version = assembler_version(inst_parser)
+    for each in inputs:
+        obj_path = object_path(each, output if len(inputs) == 1 else None)
+        if os.path.exists(obj_path) and os.path.getmtime(obj_path) >= os.path.getmtime(each):
+            try:
+                up_to_date = read_object(obj_path)['assembler'] == version
+            except (OSError, ValueError, KeyError):
+                up_to_date = False
+            if up_to_date:
+                print('--- ' + obj_path + ' up to date')
+                continue
+
+        obj = inst_parser.file_to_object(each)
+        obj.update({'format': object_format, 'format_version': object_format_version,
+                    'assembler': version, 'source': each})
+        # write to a temporary file first so that a failed run never leaves a partial object behind
+        tmp_path = obj_path + '.' + str(os.getpid()) + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(obj, f)
+        os.replace(tmp_path, obj_path)
+        print('--- ' + obj_path + ' generated')
+
+
+class OutputFiles(object):
+    """
+    output files of main(), each one is written to a temporary file next to it
+    commit() moves them all in place once they are complete, discard() drops them after an error
+    """
+
+    def __init__(self):
+        self.files = []
+
+    def open(self, file_path, mode):
+        tmp_path = file_path + '.' + str(os.getpid()) + '.tmp'
+        f = open(tmp_path, mode)
+        self.files.append((f, tmp_path, file_path))
+        return f
+
+    def commit(self):
+        for f, tmp_path, file_path in self.files:
+            f.close()
+            os.replace(tmp_path, file_path)
+        self.files = []
+
+    def discard(self):
+        for f, tmp_path, file_path in self.files:
+            f.close()
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+        self.files = []
+
+
+def write_fragments(fragments, words, c_file, h_file):
+    if words is not None:
+        words.extend(fragments['words'])
+    if c_file:
+        c_file.write(fragments['c'])
+    if h_file:
+        h_file.write(fragments['h'])
+
+
+def words_to_hex(words):
+    """
+    the .hex text of the words, one 8-digit word per line
+    """
+    return ('%08x\n' * len(words)) % tuple(words)
+
+
+def words_to_bytes(words, endian='little'):
+    """
+    the raw image of the words in the given byte order
+    """
+    image = array('I', words)
+    if endian != sys.byteorder:
+        image.byteswap()
+    return image.tobytes()
+
+
+def words_to_ihex(words, endian='little', load_addr=0, record_len=16):
+    """
+    the Intel HEX text of the words loaded at load_addr
+    """
+    if record_len < 1 or record_len > 255:
+        raise ValueError('Intel HEX record length must be in [1 : 255]')
+    data = words_to_bytes(words, endian)
+    if load_addr < 0 or load_addr + max(len(data) - 1, 0) > 0xffffffff:
+        raise ValueError('Intel HEX image must lie in the 32 bit address space')
+
+    records = []
+    upper = 0
+    pos = 0
+    while pos < len(data):
+        addr = load_addr + pos
+        if (addr >> 16) != upper:
+            # extended linear address record
+            upper = addr >> 16
+            record = bytes([2, 0, 0, 4, upper >> 8, upper & 0xff])
+            records.append(':' + record.hex().upper() + '%02X' % (-sum(record) & 0xff))
+        # a data record never crosses a 64k boundary
+        size = min(record_len, len(data) - pos, 0x10000 - (addr & 0xffff))
+        record = bytes([size, (addr >> 8) & 0xff, addr & 0xff, 0]) + data[pos:pos + size]
+        records.append(':' + record.hex().upper() + '%02X' % (-sum(record) & 0xff))
+        pos += size
+
+    records.append(':00000001FF')
+    return '\n'.join(records) + '\n'
+
+
+def words_to_srec(words, endian='little', load_addr=0, record_len=16, header=b''):
+    """
+    the Motorola S-record text of the words loaded at load_addr
+    the narrowest address field that fits the image is used: S1/S9, S2/S8 or S3/S7
+    """
+    if load_addr < 0:
+        raise ValueError('S-record load address must not be negative')
+    data = words_to_bytes(words, endian)
+    end_addr = load_addr + max(len(data) - 1, 0)
+    if end_addr <= 0xffff:
+        addr_len, data_type, term_type = 2, '1', '9'
+    elif end_addr <= 0xffffff:
+        addr_len, data_type, term_type = 3, '2', '8'
+    elif end_addr <= 0xffffffff:
+        addr_len, data_type, term_type = 4, '3', '7'
+    else:
+        raise ValueError('S-record image exceeds the 32 bit address space')
+    if record_len < 1 or record_len > 255 - addr_len - 1:
+        raise ValueError('S-record record length must be in [1 : %d]' % (255 - addr_len - 1))
+
+    def record(rec_type, addr, addr_bytes, payload):
+        body = bytes([addr_bytes + len(payload) + 1]) + addr.to_bytes(addr_bytes, 'big') + payload
+        return 'S' + rec_type + body.hex().upper() + '%02X' % (~sum(body) & 0xff)
+
+    records = [record('0', 0, 2, header)]
+    count = 0
+    for pos in range(0, len(data), record_len):
+        records.append(record(data_type, load_addr + pos, addr_len, data[pos:pos + record_len]))
+        count += 1
+    if count <= 0xffff:
+        records.append(record('5', count, 2, b''))
+    else:
+        records.append(record('6', count, 3, b''))
+    records.append(record(term_type, load_addr, addr_len, b''))
+    return '\n'.join(records) + '\n'
 
 
 def read_from_file(file_path):
     file_path = os.path.abspath(file_path)
-    f = open(file_path, 'r')
-    s = f.read()
+    with open(file_path, 'r') as f:
+        s = f.read()
     return (s)
 
-def parse_args():
+
+def iter_file_lines(file_path):
+    file_path = os.path.abspath(file_path)
+    with open(file_path, 'r') as f:
+        for line in f:
+            yield line
+
+
+def iter_text_lines(text, block_size=1 << 16):
+    """
+    the lines of text, split like io.StringIO(text) does
+    a block of whole lines is split at a time, io.StringIO keeps 4 bytes per character of all the text
+    """
+    start = 0
+    end = len(text)
+    while start < end:
+        stop = text.find('\n', start + block_size)
+        stop = end if stop < 0 else stop + 1
+        yield from io.StringIO(text[start:stop])
+        start = stop
+
+
+def server_socket_path():
+    """
+    the default socket of the server, luna_client.py looks in the same place
+    it lives in a directory only the user can reach: $XDG_RUNTIME_DIR, or luna_asm-<uid> in the temp directory
+    """
+    if 'LUNA_ASM_SOCKET' in os.environ:
+        return os.environ['LUNA_ASM_SOCKET']
+    if os.environ.get('XDG_RUNTIME_DIR'):
+        return os.path.join(os.environ['XDG_RUNTIME_DIR'], 'luna_asm.sock')
+    return os.path.join(os.environ.get('TMPDIR', '/tmp'), 'luna_asm-%d' % os.getuid(), 'luna_asm.sock')
+
+
+def check_socket_dir(socket_path, create=False):
+    """
+    fail unless the directory of the socket is a directory of the user closed to everyone else,
+    so that no other user can listen in place of the server; it is created with mode 0700 first if create is set
+    """
+    import stat
+
+    socket_dir = os.path.dirname(os.path.abspath(socket_path))
+    if create:
+        try:
+            os.mkdir(socket_dir, 0o700)
+        except FileExistsError:
+            pass
+    dir_stat = os.lstat(socket_dir)
+    if not stat.S_ISDIR(dir_stat.st_mode) or dir_stat.st_uid != os.getuid() or dir_stat.st_mode & 0o077:
+        raise ValueError('the socket directory must be a directory owned by the user with mode 0700: ' + socket_dir)
+
+
+def run_job(inst_parser, job):
+    """
+    run one job of the server and return the reply
+    {'argv': [...], 'cwd': path} runs the command line there, the reply carries its output and exit status
+    {'source': text, 'c': bool, 'h': bool} assembles in memory, the reply carries the words, labels and c / h text
+    """
+    import contextlib
+    import traceback
+
+    if 'source' in job:
+        try:
+            result = inst_parser.assemble(job['source'], job.get('c', False), job.get('h', False))
+        except ValueError as e:
+            return {'status': 1, 'error': str(e)}
+        return {'status': 0, 'words': result.words.tolist(), 'labels': result.labels, 'c': result.c, 'h': result.h}
+
+    stdout = io.StringIO()
+    stderr = io.StringIO()
+    status = 0
+    with contextlib.redirect_stdout(stdout), contextlib.redirect_stderr(stderr):
+        try:
+            os.chdir(job['cwd'])
+            args = parse_args(job['argv'])
+            if 'serve' in args or 'watch' in args:
+                raise ValueError('--serve and --watch are not jobs')
+            main(args, inst_parser)
+        except SystemExit as e:
+            # argparse exits on bad arguments, after printing the usage to stderr
+            status = e.code if isinstance(e.code, int) else 1
+        except Exception:
+            traceback.print_exc()
+            status = 1
+    return {'status': status, 'stdout': stdout.getvalue(), 'stderr': stderr.getvalue()}
+
+
+class AssemblyServer(object):
+    """
+    keeps a warm parser resident and takes jobs over a unix socket, one json line per connection
+    every job runs in a child forked from the server, so jobs run side by side and leave no state behind
+    """
+    def __init__(self, socket_path, extension=True):
+        self.socket_path = socket_path
+        self.inst_parser = InstructionParser(extension)
+        if self.inst_parser.inst_extension:
+            # the children cannot fill the lazy tables for the ones forked after them
+            self.inst_parser.inst_extension.build_tables()
+        self.children = set()
+
+    def handle(self, conn):
+        with conn.makefile('rb') as f:
+            job = json.loads(f.readline())
+        reply = run_job(self.inst_parser, job)
+        conn.sendall(json.dumps(reply).encode() + b'\n')
+
+    def reap(self):
+        # collect the finished children so that they do not linger as zombies
+        while self.children:
+            pid, _ = os.waitpid(-1, os.WNOHANG)
+            if pid == 0:
+                break
+            self.children.discard(pid)
+
+    def serve_forever(self):
+        import socket
+
+        check_socket_dir(self.socket_path, create=True)
+        if os.path.exists(self.socket_path):
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                probe.connect(self.socket_path)
+            except OSError:
+                # left behind by a server that did not shut down cleanly
+                os.unlink(self.socket_path)
+            else:
+                raise ValueError('a server is already listening on ' + self.socket_path)
+            finally:
+                probe.close()
+
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        listener.bind(self.socket_path)
+        listener.listen(64)
+        # wake up now and then to reap the children even when no job comes in
+        listener.settimeout(1.0)
+        print('--- serving on ' + self.socket_path)
+        sys.stdout.flush()
+        try:
+            while True:
+                self.reap()
+                try:
+                    conn, _ = listener.accept()
+                except socket.timeout:
+                    continue
+                conn.settimeout(None)
+                pid = os.fork()
+                if pid == 0:
+                    status = 0
+                    try:
+                        listener.close()
+                        self.handle(conn)
+                    except BaseException:
+                        import traceback
+                        traceback.print_exc()
+                        status = 1
+                    finally:
+                        os._exit(status)
+                self.children.add(pid)
+                conn.close()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            listener.close()
+            os.unlink(self.socket_path)
+
+
+def parse_args(argv=None):
     arg_parser = argparse.ArgumentParser()
-    arg_parser.add_argument('-i', type=str, required=True,
+    arg_parser.add_argument('-i', type=str, default=argparse.SUPPRESS,
                             help='path to input file or a file list separated by commas.')
     arg_parser.add_argument('-o', type=str, default=argparse.SUPPRESS,
                             help='path to output file.')
     arg_parser.add_argument('-f', type=str, default=argparse.SUPPRESS,
-                            help='specified output format. Can be [ hex / c / h ] or any combination of the three(separated by commas). Default with .c & .h files output.')
-    args = vars(arg_parser.parse_args())
+                            help='specified output format. Can be [ hex / bin / ihex / srec / c / h ] or any combination of them(separated by commas). Default with .c & .h files output. obj writes a relocatable object per input instead, see luna_link.py.')
+    arg_parser.add_argument('--endian', type=str, choices=['little', 'big'], default='little',
+                            help='byte order of the words in the .bin / .ihex / .srec files. Default with little.')
+    arg_parser.add_argument('--load-addr', type=lambda x: int(x, 0), default=0,
+                            help='byte address the image is loaded at, for the .ihex / .srec files. Default with 0.')
+    arg_parser.add_argument('--record-len', type=int, default=16,
+                            help='data bytes per record in the .ihex / .srec files. Default with 16.')
+    arg_parser.add_argument('-j', type=int, default=argparse.SUPPRESS,
+                            help='number of processes assembling the input files in parallel. 0 for one per CPU. Default with 1.')
+    arg_parser.add_argument('--cache', type=str, default=argparse.SUPPRESS,
+                            help='directory of the assembly cache. Input files whose content did not change are not assembled again.')
+    arg_parser.add_argument('--profile', type=str, nargs='?', const='', default=argparse.SUPPRESS,
+                            help='report the time, instructions/s and bytes/s of every assembly stage, per input file and in total. The label pass is timed as a whole as labels, the other stages time the encode pass. Given a path, the report is written there as JSON.')
+    arg_parser.add_argument('--watch', action='store_true', default=argparse.SUPPRESS,
+                            help='keep running and assemble again on every change of the input files, only the functions whose text changed are encoded again.')
+    arg_parser.add_argument('--serve', type=str, nargs='?', const='', default=argparse.SUPPRESS,
+                            help='keep a warm assembler running and take jobs from luna_client.py over a unix socket. Default socket with $LUNA_ASM_SOCKET, or luna_asm.sock in $XDG_RUNTIME_DIR or in luna_asm-<uid> in the temp directory. Its directory must be owned by the user with mode 0700.')
+    args = vars(arg_parser.parse_args(argv))
+    if 'i' not in args and 'serve' not in args:
+        arg_parser.error('the following arguments are required: -i')
+    if args['load_addr'] < 0 or args['load_addr'] > 0xffffffff:
+        arg_parser.error('--load-addr must be in [0 : 0xffffffff]')
+    if args['record_len'] < 1 or args['record_len'] > 255:
+        arg_parser.error('--record-len must be in [1 : 255]')
     return args
 
 
-if __name__ == "__main__":
-    if debug_flag:
-        args = {}
-        args["i"] = "luna_repeat.s"
-        args["o"] = "luna_repeat"
-    else:
-        args = parse_args()
+def main(args, inst_parser=None, watched=None, fragments_list=None):
+    """
+    run the command line with the parsed args
+    inst_parser is reused when given, e.g. the warm parser of the server
+    watched: file path -> IncrementalFile, the input files are assembled through it when given
+    fragments_list: the output fragments of the inputs when they are already assembled, e.g. linked objects
+    """
     input = args['i']
-    formats = {'hex': 0, 'h': 0, 'c': 0}
+    formats = {'hex': 0, 'bin': 0, 'ihex': 0, 'srec': 0, 'h': 0, 'c': 0, 'obj': 0}
     h_file = None
     c_file = None
     hex_file = None
+    bin_file = None
+    words = None
 
-    inst_parser = InstructionParser(True)
+    if inst_parser is None:
+        inst_parser = InstructionParser(True)
+
+    if '*.s' in args['i']:
+        import glob
+        inputs = glob.glob('*.s')
+    else:
+        inputs = args['i'].split(',')
 
     if 'o' in args:
         output = args['o']
@@ -2431,71 +3460,177 @@ if __name__ == "__main__":
         formats['h'] = 1
         formats['c'] = 1
 
-    if formats['h']:
-        h_file = open(output + '.h', 'w')
-    if formats['c']:
-        c_file = open(output + '.c', 'w')
-    if formats['hex']:
-        hex_file = open(output + '.hex', 'w')
-
-    # add a prefix to head file
-    if formats['h']:
-        for each in prefix_h:
-            h_file.write(each)
-
-    # add a prefix to c file
-    if formats['c']:
-        for each in prefix_c:
-            c_file.write(each)
-
-    # add a prefix to hex format file
-    if formats['hex']:
-        for each in prefix_hex:
-            if each.startswith('0x'):
-                hex_file.write(each[2:] + '\n')
-            else:
-                each = each.lower()
-                hex_file.write(inst_parser.parse_instruction(each, [], 0)[2:] + '\n')
-
-    if '*.s' in args['i']:
-        inputs = glob.glob('*.s')
-    else:
-        inputs = args['i'].split(',')
+    if formats['obj']:
+        # one relocatable object per input instead of an image, luna_link.py puts them together
+        print("The following files will be parsed: " + str(inputs))
+        write_objects(inst_parser, inputs, args.get('o'))
+        return
+
+    # written to temporary files and moved in place at the end, an error part-way leaves no truncated output
+    outputs = OutputFiles()
+    try:
+        if formats['h']:
+            h_file = outputs.open(output + '.h', 'w')
+        if formats['c']:
+            c_file = outputs.open(output + '.c', 'w')
+        if formats['hex']:
+            hex_file = outputs.open(output + '.hex', 'w')
+        if formats['bin']:
+            bin_file = outputs.open(output + '.bin', 'wb')
+        if formats['hex'] or formats['bin'] or formats['ihex'] or formats['srec']:
+            # encoded words of the whole image, written out in bulk at the end
+            words = array('I')
+
+        # add a prefix to head file
+        if formats['h']:
+            for each in prefix_h:
+                h_file.write(each)
+
+        # add a prefix to c file
+        if formats['c']:
+            for each in prefix_c:
+                c_file.write(each)
+
+        # add a prefix to hex and bin format files
+        if words is not None:
+            for each in prefix_hex:
+                if each.startswith('0x'):
+                    words.append(int(each, 16))
+                else:
+                    each = each.lower()
+                    words.append(inst_parser.encode_instruction(each, [], 0))
+
+        if fragments_list is None:
+            # linked objects come already assembled, nothing of -i is parsed
+            print("The following files will be parsed: " + str(inputs))
+
+        cache = None
+        if 'cache' in args:
+            cache = AssemblyCache(args['cache'], inst_parser)
+
+        jobs = 1
+        if 'j' in args:
+            jobs = args['j'] or os.cpu_count() or 1
+
+        if 'profile' in args:
+            inst_parser.profile = Profile()
+            if jobs > 1:
+                # the stages are only timed in this process
+                print('--- profile: files are assembled in this process, -j ignored')
+                jobs = 1
+
+        if fragments_list is not None:
+            for fragments in fragments_list:
+                write_fragments(fragments, words, c_file, h_file)
+        elif watched is not None:
+            for each in inputs:
+                if each not in watched:
+                    watched[each] = IncrementalFile(inst_parser, each)
+                write_fragments(watched[each].update(), words, c_file, h_file)
+        elif cache or jobs > 1:
+            for fragments in assemble_files(inst_parser, inputs, jobs, cache):
+                write_fragments(fragments, words, c_file, h_file)
+        else:
+            for each in inputs:
+                inst_parser.file_to_instruction(each, None, c_file, h_file, words)
+
+        if cache:
+            print('--- cache: %d hit, %d miss' % (cache.hits, cache.misses))
+
+        # add a suffix to head file
+        if formats['h']:
+            for each in suffix_h:
+                h_file.write(each)
+
+        # add a suffix to c file
+        if formats['c']:
+            for each in suffix_c:
+                c_file.write(each)
+
+        # add a suffix to hex and bin format files
+        if words is not None:
+            for each in suffix_hex:
+                if each.startswith('0x'):
+                    words.append(int(each, 16))
+                else:
+                    each = each.lower()
+                    words.append(inst_parser.encode_instruction(each, [], 0))
+
+        write_start = time.perf_counter()
+        if formats['hex']:
+            hex_file.write(words_to_hex(words))
+        if formats['bin']:
+            bin_file.write(words_to_bytes(words, args['endian']))
+        if formats['ihex']:
+            ihex_file = outputs.open(output + '.ihex', 'w')
+            ihex_file.write(words_to_ihex(words, args['endian'], args['load_addr'], args['record_len']))
+        if formats['srec']:
+            srec_file = outputs.open(output + '.srec', 'w')
+            srec_file.write(words_to_srec(words, args['endian'], args['load_addr'], args['record_len'],
+                                          os.path.basename(output).encode()))
+    except BaseException:
+        outputs.discard()
+        raise
+    outputs.commit()
+    for each in ['hex', 'bin', 'ihex', 'srec', 'c', 'h']:
+        if formats[each]:
+            print('--- ' + output + '.' + each + ' generated')
+
+    if 'profile' in args:
+        inst_parser.profile.add('write', time.perf_counter() - write_start)
+        if args['profile']:
+            data = inst_parser.profile.to_json()
+            data['encode_cache'] = inst_parser.encode_cache_info()
+            with open(args['profile'], 'w') as f:
+                json.dump(data, f, indent=2)
+            print('--- ' + args['profile'] + ' generated')
+        else:
+            print('--- profile')
+            sys.stdout.write(inst_parser.profile.report())
+            print('--- encode cache: %(hits)d hit, %(misses)d miss, %(size)d of %(max_size)d kept' %
+                  inst_parser.encode_cache_info())
 
-    print("The following files will be parsed: " + str(inputs))
 
-    for each in inputs:
-        content = read_from_file(each)
-        content_stripped = inst_parser.strip_content(content)
-        inst_parser.syntax_to_instruction(content_stripped, hex_file, c_file, h_file)
-
-    # add a suffix to head file
-    if formats['h']:
-        for each in suffix_h:
-            h_file.write(each)
-
-    # add a suffix to c file
-    if formats['c']:
-        for each in suffix_c:
-            c_file.write(each)
-
-    # add a suffix to hex file
-    if formats['hex']:
-        for each in suffix_hex:
-            if each.startswith('0x'):
-                hex_file.write(each[2:] + '\n')
-            else:
-                each = each.lower()
-                hex_file.write(inst_parser.parse_instruction(each, [], 0)[2:] + '\n')
-
-    if formats['hex']:
-        hex_file.close()
-        print('--- ' + output + '.hex generated')
-    if formats['c']:
-        c_file.close()
-        print('--- ' + output + '.c generated')
-    if formats['h']:
-        h_file.close()
-        print('--- ' + output + '.h generated')
+def watch(args, interval=0.2):
+    """
+    run the command line again on every change of its input files, until interrupted
+    only the functions whose text changed are encoded again
+    """
+    inst_parser = InstructionParser(True)
+    watched = {}
+    stamps = None
+    print('--- watching the input files, Ctrl-C to stop')
+    try:
+        while True:
+            current = {each: file_stamp(each) for each in watched}
+            if stamps is None or current != stamps:
+                stamps = current
+                try:
+                    main(args, inst_parser, watched)
+                except (OSError, ValueError) as e:
+                    print('--- error: ' + str(e))
+                else:
+                    print('--- watch: %d function(s) encoded, %d reused' %
+                          (sum(each.encoded for each in watched.values()),
+                           sum(each.reused for each in watched.values())))
+                for each, incremental in watched.items():
+                    stamps.setdefault(each, incremental.stamp)
+                sys.stdout.flush()
+            time.sleep(interval)
+    except KeyboardInterrupt:
+        pass
 
 
+if __name__ == "__main__":
+    if debug_flag:
+        args = {}
+        args["i"] = "luna_repeat.s"
+        args["o"] = "luna_repeat"
+    else:
+        args = parse_args()
+    if 'watch' in args:
+        watch(args)
+    elif 'serve' in args:
+        AssemblyServer(args['serve'] or server_socket_path()).serve_forever()
+    else:
+        main(args)
@@ -0,0 +1,356 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import io
+import json
+import time
+import random
+import platform
+import argparse
+import importlib.util
+import timeit
+
+# instructions timed by the dispatch microbenchmark, spread over the whole op code table
+bench_instructions = [
+    'jump #100',
+    'wait non-block, master0',
+    'cmp r1, #5',
+    'b #-3',
+    'bge #5',
+    'ldr r1, [r2]',
+    'pop {r4-r6}',
+    'push {lr}',
+    'setr r1, #3, #100',
+    'add r1, #5',
+    'subl r1, r2',
+    'andm r1, #1',
+    'xorl r1, #1',
+    'lsr r1, r2',
+    'mulhm r1, r2',
+    'movl r1, #40000',
+    'cmovge r1, r2',
+    'dstm0 master0, config1, enable=constant',
+    'ares master, select0, chs[1010], sel_row2, cmc[0101], ces[10101010]',
+    'seti reg_mode, reg=r5',
+]
+
+
+def load_module(file_path):
+    """
+    import a luna_asm.py from an explicit path, e.g. a copy taken from an older revision
+    """
+    file_path = os.path.abspath(file_path)
+    name = 'luna_asm_' + str(abs(hash(file_path)))
+    spec = importlib.util.spec_from_file_location(name, file_path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def bench_dispatch(modules, number, repeat):
+    """
+    time parse_instruction per instruction for every module, returns [{instruction: nanoseconds per call}]
+    runs of the modules are interleaved so that machine noise hits all of them alike
+    the encode cache is off, the same text timed over and over would only measure cache hits
+    """
+    timers = []
+    for module in modules:
+        inst_parser = module.InstructionParser(True)
+        inst_parser.encode_cache_size = 0
+        inst_label_list = module.InstFuncLabel()
+        timers.append((inst_parser, inst_label_list))
+
+    results = [{} for each in modules]
+    for inst in bench_instructions:
+        best = [None] * len(modules)
+        for run in range(repeat):
+            for i, (inst_parser, inst_label_list) in enumerate(timers):
+                timer = timeit.Timer(lambda: inst_parser.parse_instruction(inst, inst_label_list, 0))
+                elapsed = timer.timeit(number=number)
+                if best[i] is None or elapsed < best[i]:
+                    best[i] = elapsed
+        for i in range(len(modules)):
+            results[i][inst] = best[i] / number * 1e9
+    return results
+
+
+def print_dispatch(current, baseline):
+    print('%-44s %12s %12s %8s' % ('instruction', 'current ns', 'baseline ns', 'speedup'))
+    for inst in bench_instructions:
+        if baseline:
+            print('%-44s %12.0f %12.0f %7.2fx' % (inst, current[inst], baseline[inst],
+                                                  baseline[inst] / current[inst]))
+        else:
+            print('%-44s %12.0f' % (inst, current[inst]))
+
+    total = sum(current.values())
+    if baseline:
+        total_base = sum(baseline.values())
+        print('%-44s %12.0f %12.0f %7.2fx' % ('total', total, total_base, total_base / total))
+    else:
+        print('%-44s %12.0f' % ('total', total))
+
+
+# consecutive instructions merged into one by the assembler
+merge_runs = [
+    ['dstm0 master0, enable=constant', 'dstm0 config1', 'dstm0 hold=1'],
+    ['dstm0 slave0, stride=1', 'dstm0 master1'],
+    ['ares master, select0, chs[1010]', 'ares sel_row2', 'ares cmc[0101]', 'ares ces[10101010]'],
+    ['ares mode=0, sel=1, or', 'ares elf[1111]', 'ares efcs[10101010]'],
+]
+
+alu_ops = ['add', 'sub', 'and', 'orr', 'xor', 'not', 'mov', 'lsl', 'lsr', 'asr', 'mul', 'cmov']
+
+workload_mixes = ['branch', 'comment', 'merge', 'imm', 'mixed']
+
+
+def random_reg(rng):
+    return 'r%d' % rng.randint(0, 28)
+
+
+def gen_alu(rng):
+    op = rng.choice(alu_ops)
+    if op in ('mul', 'not', 'cmov') or rng.random() < 0.5:
+        return '%s %s, %s' % (op, random_reg(rng), random_reg(rng))
+    if op in ('lsl', 'lsr', 'asr'):
+        return '%s %s, #%d' % (op, random_reg(rng), rng.randint(0, 31))
+    return '%s %s, #%d' % (op, random_reg(rng), rng.randint(0, 255))
+
+
+def gen_imm(rng):
+    reg = random_reg(rng)
+    return rng.choice([
+        'setrh %s, #0x%04x' % (reg, rng.randint(0, 0xFFFF)),
+        'setrl %s, #0x%04x' % (reg, rng.randint(0, 0xFFFF)),
+        'movl %s, #%d' % (reg, rng.randint(32768, 65535)),
+        'mov %s, #%d' % (reg, rng.randint(-32768, -1)),
+        'add %s, #%d' % (reg, rng.randint(-32768, 65535)),
+        'andl %s, #0x%x' % (reg, rng.randint(0, 0xFFFF)),
+        'ldro %s, %s, #%d' % (reg, random_reg(rng), rng.randint(-16384, 16383)),
+        'lea %s, %s, #%d' % (reg, random_reg(rng), rng.randint(-32768, 32767)),
+        'jump #%d' % rng.randint(-(1 << 23), (1 << 23) - 1),
+    ])
+
+
+def generate_program(mix, size, seed=0):
+    """
+    a synthetic .s source of about size instructions
+    mix is one of workload_mixes:
+    branch: short functions and local labels with conditional branches between them
+    comment: line, trailing and block comments, blank lines and directives around the instructions
+    merge: runs of dstm0 / ares instructions merged by the assembler
+    imm: wide and signed immediate numbers
+    mixed: all of the above
+    """
+    rng = random.Random('%s-%d-%d' % (mix, size, seed))
+    lines = ['bench_%s:' % mix]
+    labels = []
+    count = 0
+    while count < size:
+        kind = mix
+        if mix == 'mixed':
+            kind = rng.choice(['branch', 'comment', 'merge', 'imm', 'alu'])
+
+        if kind == 'branch':
+            if rng.random() < 0.15:
+                label = ('func%d' if rng.random() < 0.3 else '__local%d') % len(labels)
+                labels.append(label)
+                lines.append(label + ':')
+            if labels and rng.random() < 0.5:
+                # branch to a nearby label, far enough to hit both directions
+                target = labels[rng.randint(max(0, len(labels) - 20), len(labels) - 1)]
+                lines.append('    cmp %s, #%d' % (random_reg(rng), rng.randint(0, 100)))
+                lines.append('    %s %s' % (rng.choice(['b', 'beq', 'bne', 'bgt', 'blt', 'bl']), target))
+                count += 2
+            else:
+                lines.append('    ' + gen_alu(rng))
+                count += 1
+        elif kind == 'comment':
+            roll = rng.random()
+            if roll < 0.2:
+                lines.append('    // %s' % ('comment ' * rng.randint(1, 8)))
+            elif roll < 0.3:
+                lines.append('    /* block comment')
+                lines.append('       %s */ %s' % ('text ' * rng.randint(1, 6), gen_alu(rng)))
+                count += 1
+            elif roll < 0.35:
+                lines.append('.section .text')
+            elif roll < 0.4:
+                lines.append('')
+            lines.append('    %s // %s' % (gen_alu(rng), 'note ' * rng.randint(1, 4)))
+            count += 1
+        elif kind == 'merge':
+            run = rng.choice(merge_runs)
+            for each in run:
+                lines.append('    ' + each)
+            count += len(run)
+            # a merge run ends at the next instruction that is not part of it
+            lines.append('    ' + gen_alu(rng))
+            count += 1
+        elif kind == 'imm':
+            lines.append('    ' + gen_imm(rng))
+            count += 1
+        else:
+            lines.append('    ' + gen_alu(rng))
+            count += 1
+
+    lines.append('    wait block')
+    return '\n'.join(lines) + '\n'
+
+
+def bench_workload(module, source, repeat):
+    """
+    best seconds of the full syntax_to_instruction path, and of every stage when the module can profile them
+    """
+    inst_parser = module.InstructionParser(True)
+    best = None
+    for run in range(repeat):
+        hex_file, c_file, h_file = io.StringIO(), io.StringIO(), io.StringIO()
+        start = time.perf_counter()
+        inst_parser.syntax_to_instruction(inst_parser.strip_content(source), hex_file, c_file, h_file)
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+
+    stages = {}
+    if hasattr(module, 'Profile'):
+        for run in range(repeat):
+            inst_parser.profile = module.Profile()
+            inst_parser.assemble(source, True, True)
+            for stage, values in inst_parser.profile.to_json()['total']['stages'].items():
+                if stage not in stages or values['seconds'] < stages[stage]:
+                    stages[stage] = values['seconds']
+        inst_parser.profile = None
+    return best, stages
+
+
+def bench_suite(modules, mixes, size, seed, repeat):
+    """
+    time every workload for every module, returns [{mix: {'instructions', 'bytes', 'seconds', 'stages'}}]
+    """
+    results = [{} for each in modules]
+    for mix in mixes:
+        source = generate_program(mix, size, seed)
+        instructions = len(modules[0].assemble(source).words)
+        for i, module in enumerate(modules):
+            seconds, stages = bench_workload(module, source, repeat)
+            results[i][mix] = {'instructions': instructions, 'bytes': len(source.encode()),
+                               'seconds': seconds, 'stages': stages}
+    return results
+
+
+def print_suite(current, baseline):
+    print('%-10s %12s %12s %14s %12s %8s' % ('workload', 'instructions', 'seconds', 'inst/s',
+                                             'baseline s', 'speedup'))
+    for mix, result in current.items():
+        line = '%-10s %12d %12.6f %14.0f' % (mix, result['instructions'], result['seconds'],
+                                             result['instructions'] / result['seconds'])
+        if baseline and mix in baseline:
+            line += ' %12.6f %7.2fx' % (baseline[mix]['seconds'], baseline[mix]['seconds'] / result['seconds'])
+        print(line)
+        if result['stages']:
+            print('%-10s %s' % ('', '  '.join('%s %.6f' % (stage, seconds)
+                                                for stage, seconds in result['stages'].items())))
+
+
+def check_suite(current, saved, threshold):
+    """
+    the workloads slower than their saved time by more than the threshold
+    a saved workload may carry its own 'threshold'
+    """
+    regressions = []
+    for mix, result in current.items():
+        if mix not in saved:
+            continue
+        limit = saved[mix].get('threshold', threshold)
+        if result['seconds'] > saved[mix]['seconds'] * (1 + limit):
+            regressions.append('%s: %.6f s against %.6f s saved, over the %d%% threshold' %
+                               (mix, result['seconds'], saved[mix]['seconds'], limit * 100))
+    return regressions
+
+
+def parse_args():
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument('--asm', type=str, default=os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                                                  'luna_asm.py'),
+                            help='path to the luna_asm.py under test.')
+    arg_parser.add_argument('--baseline', type=str, default=None,
+                            help='path to another luna_asm.py to compare against, '
+                                 'e.g. the output of "git show HEAD~1:luna_asm.py".')
+    arg_parser.add_argument('-n', type=int, default=20000,
+                            help='calls per timing run.')
+    arg_parser.add_argument('-r', type=int, default=5,
+                            help='timing runs per instruction, the best one is reported.')
+    arg_parser.add_argument('--suite', action='store_true',
+                            help='time synthetic workloads through the whole assembler instead of the dispatch.')
+    arg_parser.add_argument('--mix', type=str, default=','.join(workload_mixes),
+                            help='workloads of the suite separated by commas, of [ %s ].' % ' / '.join(workload_mixes))
+    arg_parser.add_argument('--size', type=int, default=20000,
+                            help='instructions per workload of the suite.')
+    arg_parser.add_argument('--seed', type=int, default=0,
+                            help='seed of the workload generator.')
+    arg_parser.add_argument('--save', type=str, default=argparse.SUPPRESS,
+                            help='write the suite results to a JSON baseline file.')
+    arg_parser.add_argument('--check', type=str, default=argparse.SUPPRESS,
+                            help='compare the suite against a JSON baseline file, exit with 1 on a regression. '
+                                 'The workloads are generated with the size and seed saved in the file.')
+    arg_parser.add_argument('--threshold', type=float, default=0.15,
+                            help='slowdown of a workload over its saved time that counts as a regression.')
+    arg_parser.add_argument('--dump', type=str, default=argparse.SUPPRESS,
+                            help='directory to write the generated workloads to, as .s files.')
+    args = vars(arg_parser.parse_args())
+    return args
+
+
+def run_suite(args, modules):
+    mixes = args['mix'].split(',')
+    size = args['size']
+    seed = args['seed']
+    saved = None
+    if 'check' in args:
+        with open(args['check'], 'r') as f:
+            saved = json.load(f)
+        size = saved['size']
+        seed = saved['seed']
+
+    if 'dump' in args:
+        os.makedirs(args['dump'], exist_ok=True)
+        for mix in mixes:
+            with open(os.path.join(args['dump'], 'bench_%s.s' % mix), 'w') as f:
+                f.write(generate_program(mix, size, seed))
+
+    results = bench_suite(modules, mixes, size, seed, args['r'])
+    print_suite(results[0], results[1] if len(results) > 1 else None)
+
+    if 'save' in args:
+        with open(args['save'], 'w') as f:
+            json.dump({'size': size, 'seed': seed, 'python': platform.python_version(),
+                       'machine': platform.machine(), 'workloads': results[0]}, f, indent=2)
+        print('--- ' + args['save'] + ' generated')
+
+    if saved is not None:
+        regressions = check_suite(results[0], saved['workloads'], args['threshold'])
+        for each in regressions:
+            print('--- regression: ' + each)
+        if regressions:
+            sys.exit(1)
+        print('--- no regression against ' + args['check'])
+
+
+if __name__ == "__main__":
+    args = parse_args()
+
+    modules = [load_module(args['asm'])]
+    if args['baseline']:
+        modules.append(load_module(args['baseline']))
+
+    if args['suite']:
+        run_suite(args, modules)
+        sys.exit(0)
+
+    results = bench_dispatch(modules, args['n'], args['r'])
+    current = results[0]
+    baseline = results[1] if args['baseline'] else None
+
+    print_dispatch(current, baseline)
@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+
+# thin client of `luna_asm.py --serve`, it takes the same arguments as luna_asm.py
+# only what it needs to talk to the server is imported here, luna_asm itself is loaded when no server runs
+
+import os
+import sys
+import json
+import stat
+import socket
+
+
+def server_socket_path():
+    """
+    the default socket of the server, the same as luna_asm.server_socket_path()
+    """
+    if 'LUNA_ASM_SOCKET' in os.environ:
+        return os.environ['LUNA_ASM_SOCKET']
+    if os.environ.get('XDG_RUNTIME_DIR'):
+        return os.path.join(os.environ['XDG_RUNTIME_DIR'], 'luna_asm.sock')
+    return os.path.join(os.environ.get('TMPDIR', '/tmp'), 'luna_asm-%d' % os.getuid(), 'luna_asm.sock')
+
+
+def check_socket_dir(socket_path):
+    """
+    fail unless the directory of the socket is a directory of the user closed to everyone else,
+    the same check as luna_asm.check_socket_dir(), so that no other user's listener gets the jobs
+    raises FileNotFoundError when the directory does not exist, i.e. no server ever ran
+    """
+    socket_dir = os.path.dirname(os.path.abspath(socket_path))
+    dir_stat = os.lstat(socket_dir)
+    if not stat.S_ISDIR(dir_stat.st_mode) or dir_stat.st_uid != os.getuid() or dir_stat.st_mode & 0o077:
+        raise ValueError('the socket directory must be a directory owned by the user with mode 0700: ' + socket_dir)
+
+
+def send(job, socket_path=None):
+    """
+    send one job to the server and return its reply
+    raises FileNotFoundError or ConnectionRefusedError when no server listens on the socket
+    """
+    socket_path = socket_path or server_socket_path()
+    check_socket_dir(socket_path)
+    conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        conn.connect(socket_path)
+        conn.sendall(json.dumps(job).encode() + b'\n')
+        with conn.makefile('rb') as f:
+            reply = f.readline()
+    finally:
+        conn.close()
+    if not reply:
+        raise ValueError('the server closed the connection without a reply')
+    return json.loads(reply)
+
+
+def assemble(source, c=False, h=False, socket_path=None):
+    """
+    assemble source text on the server, the reply has the words, labels and c / h text
+    """
+    reply = send({'source': source, 'c': c, 'h': h}, socket_path)
+    if reply['status']:
+        raise ValueError(reply['error'])
+    return reply
+
+
+def run(argv, socket_path=None):
+    """
+    run the luna_asm.py command line on the server and return its exit status
+    """
+    reply = send({'argv': argv, 'cwd': os.getcwd()}, socket_path)
+    sys.stdout.write(reply['stdout'])
+    sys.stderr.write(reply['stderr'])
+    return reply['status']
+
+
+if __name__ == "__main__":
+    argv = sys.argv[1:]
+    try:
+        status = run(argv)
+    except (FileNotFoundError, ConnectionRefusedError):
+        # no server, assemble in this process instead
+        import luna_asm
+        luna_asm.main(luna_asm.parse_args(argv))
+        status = 0
+    sys.exit(status)
@@ -0,0 +1,391 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import argparse
+import itertools
+from array import array
+
+from luna_asm import InstructionParser, InstructionExtension
+
+# numpy is optional, it decodes large images in bulk when installed
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+if numpy is not None:
+    # hex digit -> value, for reading .hex images in bulk
+    hex_chars = numpy.frombuffer(b'0123456789abcdefABCDEF', dtype=numpy.uint8)
+    hex_values = numpy.zeros(256, dtype=numpy.uint8)
+    for value, char in enumerate(b'0123456789abcdef'):
+        hex_values[char] = value
+    for value, char in enumerate(b'ABCDEF'):
+        hex_values[char] = value + 10
+
+
+class DecodeEntry(object):
+    """
+    one encoding of an op code: the word matches when (word & mask) == code
+    the bits outside mask are the operand fields, rendered by render(values)
+    """
+    __slots__ = ('op_code', 'code', 'mask', 'fields', 'render')
+
+    def __init__(self, op_code, code, mask, fields, render):
+        self.op_code = op_code
+        self.code = code
+        self.mask = mask
+        self.fields = fields  # [(bit, width, signed, base added to the value)]
+        self.render = render
+
+    def values(self, word):
+        values = []
+        for bit, width, signed, base in self.fields:
+            val = (word >> bit) & ((1 << width) - 1)
+            if signed and val >> (width - 1):
+                val -= (1 << width)
+            values.append(val + base)
+        return tuple(values)
+
+    def columns(self, words):
+        """
+        the field values of a numpy array of words, a column per field
+        """
+        columns = []
+        for bit, width, signed, base in self.fields:
+            val = (words >> bit) & ((1 << width) - 1)
+            if signed:
+                val = numpy.where(val >> (width - 1), val - (1 << width), val)
+            columns.append(val + base)
+        return columns
+
+
+def entry_mask(fields):
+    """
+    the bits of a word not taken by the fields
+    """
+    bits = 0
+    for bit, width, signed, base in fields:
+        bits |= ((1 << width) - 1) << bit
+    return 0xFFFFFFFF & ~bits
+
+
+def format_render(text):
+    return text.__mod__
+
+
+def render_ldm(values):
+    # the registers of the list are the zero bits of the mask, the head register is always loaded
+    mem, head, msk = values
+    regs = [head] + [head + i for i in range(1, 8) if not (msk >> (i - 1)) & 1]
+    if len(regs) > 1 and regs[-1] - head == len(regs) - 1:
+        return 'ldm [r%d], {r%d-r%d}' % (mem, head, regs[-1])
+    return 'ldm [r%d], ' % mem + ', '.join('r%d' % each for each in regs)
+
+
+class Disassembler(object):
+    """
+    decode words back to instructions that assemble to the same words
+    the decode tables are built from the op code tables of InstructionParser and InstructionExtension
+    """
+    def __init__(self, extension=True):
+        # op code bits -> decode entries of the op codes sharing them, most specific first
+        self.groups = {}
+        for op_code, (encoder, fixed, kind) in InstructionParser.op_dispatch.items():
+            code = (InstructionParser.instruction_dict[op_code] << 26) + fixed
+            if encoder in InstructionParser.instruction_fields:
+                entries = self.layout_entries(op_code, code, InstructionParser.instruction_fields[encoder])
+            else:
+                entries = getattr(self, 'entries_' + encoder[len('parse_op_'):])(op_code, code)
+            for entry in entries:
+                self.add_entry(entry)
+
+        if extension:
+            for op_code, op_bits in InstructionExtension.instruction_dict.items():
+                if op_code == 'seti':
+                    entries = self.entries_seti(op_code, op_bits << 26)
+                else:
+                    # the parameters are written back as the raw bits of '#N'
+                    fields = [(0, 26, False, 0)]
+                    entries = [DecodeEntry(op_code, op_bits << 26, entry_mask(fields), fields,
+                                           format_render(op_code + ' #0x%x'))]
+                for entry in entries:
+                    self.add_entry(entry)
+
+        for op_bits, entries in self.groups.items():
+            # a stable sort keeps the op code table order among equally specific entries, e.g. b before bx
+            entries.sort(key=lambda entry: -bin(entry.mask).count('1'))
+
+    def add_entry(self, entry):
+        if entry.code & ~entry.mask:
+            raise ValueError('decode entry of %s has fixed bits inside its fields' % entry.op_code)
+        self.groups.setdefault(entry.code >> 26, []).append(entry)
+
+    def layout_entries(self, op_code, code, layout):
+        """
+        the entries of an instruction_fields layout, a source operand adds one entry per form
+        """
+        forms = []
+        for field in layout:
+            kind = field[0]
+            bit = field[1]
+            if kind == InstructionParser.FIELD_REG:
+                forms.append([(0, [(bit, 5, False, 0)], 'r%d')])
+            elif kind == InstructionParser.FIELD_MEM:
+                forms.append([(0, [(bit, 5, False, 0)], '[r%d]')])
+            elif kind == InstructionParser.FIELD_IMM or kind == InstructionParser.FIELD_HASH_IMM:
+                forms.append([(0, [(bit, field[2], field[3] == InstructionParser.IMM_SIGNED, 0)], '#%d')])
+            elif kind == InstructionParser.FIELD_SRC:
+                width = field[2]
+                reg_code = field[4] if len(field) > 4 else 0
+                src = [(reg_code, [(bit, 5, False, 0)], 'r%d')]
+                if field[3] == InstructionParser.IMM_BOTH:
+                    src.append((InstructionParser.SRC_IMM, [(0, width, True, 0)], '#%d'))
+                    # the flag is only set above the signed range, the top bit of the immediate is fixed
+                    top = 1 << (width - 1)
+                    src.append((InstructionParser.SRC_IMM + InstructionParser.SRC_UNSIGNED + top,
+                                [(0, width - 1, False, top)], '#%d'))
+                else:
+                    src.append((InstructionParser.SRC_IMM, [(0, width, False, 0)], '#%d'))
+                forms.append(src)
+            else:
+                raise ValueError('unknown operand field kind: ' + str(kind))
+
+        entries = []
+        for form in itertools.product(*forms):
+            fields = []
+            for each in form:
+                fields.extend(each[1])
+            text = op_code + ' ' + ', '.join(each[2] for each in form)
+            entries.append(DecodeEntry(op_code, code + sum(each[0] for each in form), entry_mask(fields),
+                                       fields, format_render(text)))
+        return entries
+
+    def entries_b(self, op_code, code):
+        # the offset of a label is written back as '#N', relative to the branch
+        imm = [(0, 16, True, 0)]
+        reg = [(8, 5, False, 0)]
+        return [DecodeEntry(op_code, code + (0b1 << 24), entry_mask(imm), imm, format_render(op_code + ' #%d')),
+                DecodeEntry(op_code, code + (0b1 << 23), entry_mask(reg), reg, format_render(op_code + ' r%d'))]
+
+    def entries_wait(self, op_code, code):
+        fields = [(0, 26, False, 0)]
+        return [DecodeEntry(op_code, code, entry_mask(fields), fields, format_render(op_code + ' #0x%x'))]
+
+    def entries_ldm(self, op_code, code):
+        # bit 0 of the register mask stands for the head register, which is always in the list
+        fields = [(8, 5, False, 0), (15, 5, False, 0), (1, 7, False, 0)]
+        return [DecodeEntry(op_code, code + (0b01 << 23), entry_mask(fields), fields, render_ldm)]
+
+    def entries_stm(self, op_code, code):
+        # only the head of a register range is encoded
+        fields = [(8, 5, False, 0), (15, 5, False, 0)]
+        return [DecodeEntry(op_code, code + (0b01 << 23), entry_mask(fields), fields,
+                            format_render(op_code + ' [r%d], r%d'))]
+
+    def entries_pop(self, op_code, code):
+        # the stack is [r31], only the head of a register range is encoded
+        fields = [(15, 5, False, 0)]
+        code += (0b1 << 24) + (31 << 8)
+        return [DecodeEntry(op_code, code, entry_mask(fields), fields, format_render(op_code + ' {r%d}')),
+                DecodeEntry(op_code, code + (0b01 << 23), entry_mask(fields), fields,
+                            format_render(op_code + ' {r%d-}'))]
+
+    entries_push = entries_pop
+
+    def entries_setih(self, op_code, code):
+        # never encoded, the words of the op code are seti ones
+        return []
+
+    entries_setil = entries_setih
+
+    def entries_seti(self, op_code, code):
+        entries = []
+        for mode, counter in InstructionExtension.operand_seti_mode_paras.items():
+            params = InstructionExtension.operand_seti_params[counter]
+            # a number parameter runs up to the next parameter, the mode sits at bit 22
+            bits = sorted([param['bit'] for param in params.values()] + [22])
+            fields = []
+            texts = [op_code + ' ' + mode]
+            for name, param in params.items():
+                if isinstance(param['val'], str):
+                    fields.append((param['bit'], 5, False, 0))
+                    texts.append(name + '=r%d')
+                else:
+                    fields.append((param['bit'], bits[bits.index(param['bit']) + 1] - param['bit'], False, 0))
+                    texts.append(name + '=%d')
+            entries.append(DecodeEntry(op_code, code + (counter << 22), entry_mask(fields), fields,
+                                       format_render(', '.join(texts))))
+        return entries
+
+    def unknown(self, word):
+        return '.word 0x%08x' % word
+
+    def decode(self, word):
+        """
+        the entry the word matches and its field values, or (None, None) when no entry does
+        """
+        for entry in self.groups.get(word >> 26, ()):
+            if word & entry.mask == entry.code:
+                return entry, entry.values(word)
+        return None, None
+
+    def disassemble_word(self, word):
+        entry, values = self.decode(word)
+        if entry is None:
+            return self.unknown(word)
+        return entry.render(values)
+
+    def disassemble(self, words):
+        """
+        the instruction text of every word, a word repeated in the image is decoded once
+        """
+        if numpy is not None:
+            return self.disassemble_array(words).tolist()
+        texts = {}
+        for word in words:
+            if word not in texts:
+                texts[word] = self.disassemble_word(word)
+        return [texts[word] for word in words]
+
+    def disassemble_array(self, words):
+        """
+        numpy path of disassemble, returns an object array of the texts
+        the distinct words are split into op code and fields a whole entry at a time
+        """
+        words = numpy.asarray(words, dtype=numpy.uint32)
+        uniq, inverse = numpy.unique(words, return_inverse=True)
+        uniq = uniq.astype(numpy.int64)
+        texts = numpy.empty(len(uniq), dtype=object)
+        decoded = numpy.zeros(len(uniq), dtype=bool)
+        op_bits = uniq >> 26
+
+        for bits, entries in self.groups.items():
+            left = numpy.nonzero(op_bits == bits)[0]
+            for entry in entries:
+                if len(left) == 0:
+                    break
+                hit = (uniq[left] & entry.mask) == entry.code
+                if not hit.any():
+                    continue
+                index = left[hit]
+                left = left[~hit]
+                rows = zip(*[column.tolist() for column in entry.columns(uniq[index])])
+                texts[index] = [entry.render(row) for row in rows]
+                decoded[index] = True
+
+        for i in numpy.nonzero(~decoded)[0]:
+            texts[i] = self.unknown(int(uniq[i]))
+        return texts[inverse.reshape(-1)]
+
+
+def read_words(file_path, endian='little'):
+    """
+    the words of a .hex (one hex word per line) or a raw .bin image
+    a numpy array when numpy is installed, else an array('I')
+    """
+    with open(os.path.abspath(file_path), 'rb') as f:
+        data = f.read()
+
+    if not file_path.endswith('.hex'):
+        if len(data) % 4:
+            raise ValueError('binary image size is not a multiple of 4: ' + file_path)
+        if numpy is not None:
+            return numpy.frombuffer(data, dtype=('<u4' if endian == 'little' else '>u4')).astype(numpy.uint32)
+        words = array('I')
+        words.frombytes(data)
+        if endian != sys.byteorder:
+            words.byteswap()
+        return words
+
+    if numpy is not None and len(data) % 9 == 0:
+        # the layout written by the assembler, 8 hex digits and a newline per word
+        chars = numpy.frombuffer(data, dtype=numpy.uint8).reshape(-1, 9)
+        digits = chars[:, :8]
+        if (chars[:, 8] == ord('\n')).all() and numpy.isin(digits, hex_chars).all():
+            nibbles = hex_values[digits].astype(numpy.uint32)
+            words = numpy.zeros(len(chars), dtype=numpy.uint32)
+            for i in range(8):
+                words = (words << 4) | nibbles[:, i]
+            return words
+
+    words = array('I', [int(each, 16) for each in data.split()])
+    if numpy is not None:
+        return numpy.asarray(words, dtype=numpy.uint32)
+    return words
+
+
+def diff_index(words, other):
+    """
+    the indexes where two images differ, the tail of the longer one included
+    """
+    count = min(len(words), len(other))
+    if numpy is not None:
+        index = numpy.nonzero(numpy.asarray(words[:count]) != numpy.asarray(other[:count]))[0].tolist()
+    else:
+        index = [i for i in range(count) if words[i] != other[i]]
+    return index + list(range(count, max(len(words), len(other))))
+
+
+def listing(words, disassembler, load_addr=0):
+    """
+    address, word and instruction of every word
+    """
+    # only the address differs between the lines of a repeated word
+    distinct = list(set(words))
+    tails = {}
+    for word, text in zip(distinct, disassembler.disassemble(distinct)):
+        tails[word] = '%08x    %s\n' % (word, text)
+    addrs = map('%08x: '.__mod__, range(load_addr, load_addr + len(words) * 4, 4))
+    return ''.join(map(str.__add__, addrs, map(tails.__getitem__, words)))
+
+
+def diff_listing(words, other, index, texts, other_texts, load_addr=0):
+    lines = []
+    for i, text, other_text in zip(index, texts, other_texts):
+        left = '%08x    %-40s' % (words[i], text) if i < len(words) else '%-52s' % '-'
+        right = '%08x    %s' % (other[i], other_text) if i < len(other) else '-'
+        lines.append('%08x: %s | %s\n' % (load_addr + i * 4, left, right))
+    return ''.join(lines)
+
+
+def parse_args():
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument('-i', type=str, required=True,
+                            help='path to the input image, a .hex file or a raw binary file.')
+    arg_parser.add_argument('-o', type=str, default=argparse.SUPPRESS,
+                            help='path to output file. Default with the standard output.')
+    arg_parser.add_argument('--diff', type=str, default=argparse.SUPPRESS,
+                            help='path to another image, only the words differing between the two are listed.')
+    arg_parser.add_argument('--endian', type=str, choices=['little', 'big'], default='little',
+                            help='byte order of the words in a binary image. Default with little.')
+    arg_parser.add_argument('--load-addr', type=lambda x: int(x, 0), default=0,
+                            help='byte address the image is loaded at. Default with 0.')
+    arg_parser.add_argument('--no-extension', action='store_true',
+                            help='decode the core instructions only.')
+    args = vars(arg_parser.parse_args())
+    return args
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    disassembler = Disassembler(not args['no_extension'])
+
+    words = read_words(args['i'], args['endian'])
+    if 'diff' in args:
+        other = read_words(args['diff'], args['endian'])
+        index = diff_index(words, other)
+        texts = disassembler.disassemble([int(words[i]) for i in index if i < len(words)])
+        other_texts = disassembler.disassemble([int(other[i]) for i in index if i < len(other)])
+        texts += [''] * (len(index) - len(texts))
+        other_texts += [''] * (len(index) - len(other_texts))
+        text = diff_listing(words, other, index, texts, other_texts, args['load_addr'])
+    else:
+        text = listing(words.tolist(), disassembler, args['load_addr'])
+
+    if 'o' in args:
+        with open(args['o'], 'w') as f:
+            f.write(text)
+        print('--- ' + args['o'] + ' generated')
+    else:
+        sys.stdout.write(text)
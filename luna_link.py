@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+
+import io
+import argparse
+
+from luna_asm import InstructionParser, read_object, main
+
+
+def link(objects):
+    """
+    lay the objects out one after the other, in order, and patch the branches between them
+    objects: [(path, object)], the words of the objects are patched in place
+    returns label -> position in the image of every symbol
+    """
+    symbols = {}
+    owners = {}
+    bases = []
+    base = 0
+    for path, obj in objects:
+        for label, pos in obj['symbols'].items():
+            if label in symbols:
+                raise ValueError('duplicated symbol: ' + label + ' in ' + owners[label] + ' and ' + path)
+            symbols[label] = base + pos
+            owners[label] = path
+        bases.append(base)
+        base += len(obj['words'])
+
+    for (path, obj), base in zip(objects, bases):
+        words = obj['words']
+        for pos, label in obj['relocations']:
+            if label not in symbols:
+                raise ValueError('undefined symbol: ' + label + ', branched to from ' + path)
+            # the branch was encoded with a zero offset, the offset takes the low 16 bits
+            offset = symbols[label] - (base + pos)
+            if offset > 32767 or offset < -32768:
+                raise ValueError('b instruction has an out range offset: ' + str(offset))
+            words[pos] = (words[pos] & ~0xFFFF) | (offset & 0xFFFF)
+
+    return symbols
+
+
+def object_fragments(inst_parser, obj, c=True, h=True):
+    """
+    the output fragments of a linked object, as main() writes them
+    """
+    c_file = io.StringIO() if c else None
+    h_file = io.StringIO() if h else None
+    if c or h:
+        labels = obj['labels']
+        records = ((inst, labels.get(pos, ''), code) for pos, (inst, code) in enumerate(zip(obj['insts'], obj['words'])))
+        inst_parser.emit_instructions(records, None, c_file, h_file)
+
+    return {'words': obj['words'], 'c': c_file.getvalue() if c else '', 'h': h_file.getvalue() if h else ''}
+
+
+def parse_args():
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument('-i', type=str, required=True,
+                            help='object files written by luna_asm.py -f obj, separated by commas. They are laid out in this order.')
+    arg_parser.add_argument('-o', type=str, default=argparse.SUPPRESS,
+                            help='path to output file.')
+    arg_parser.add_argument('-f', type=str, default=argparse.SUPPRESS,
+                            help='specified output format. Can be [ hex / bin / ihex / srec / c / h ] or any combination of them(separated by commas). Default with .c & .h files output.')
+    arg_parser.add_argument('--endian', type=str, choices=['little', 'big'], default='little',
+                            help='byte order of the words in the .bin / .ihex / .srec files. Default with little.')
+    arg_parser.add_argument('--load-addr', type=lambda x: int(x, 0), default=0,
+                            help='byte address the image is loaded at, for the .ihex / .srec files. Default with 0.')
+    arg_parser.add_argument('--record-len', type=int, default=16,
+                            help='data bytes per record in the .ihex / .srec files. Default with 16.')
+    args = vars(arg_parser.parse_args())
+    if 'f' in args and 'obj' in args['f'].split(','):
+        arg_parser.error('obj is not an output format of the linker')
+    if args['load_addr'] < 0 or args['load_addr'] > 0xffffffff:
+        arg_parser.error('--load-addr must be in [0 : 0xffffffff]')
+    if args['record_len'] < 1 or args['record_len'] > 255:
+        arg_parser.error('--record-len must be in [1 : 255]')
+    return args
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    formats = args['f'].split(',') if 'f' in args else ['c', 'h']
+
+    inputs = args['i'].split(',')
+    objects = [(each, read_object(each)) for each in inputs]
+    symbols = link(objects)
+    print('--- %d object(s) linked, %d symbol(s)' % (len(objects), len(symbols)))
+
+    inst_parser = InstructionParser(True)
+    fragments_list = [object_fragments(inst_parser, obj, 'c' in formats, 'h' in formats) for path, obj in objects]
+    main(args, inst_parser, fragments_list=fragments_list)
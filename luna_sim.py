@@ -0,0 +1,545 @@
+#!/usr/bin/env python3
+"""
+instruction-set simulator of the core Luna instructions, run on the assembled words
+
+the encodings are the ones of InstructionParser, the behaviour below is what the simulator assumes:
+- 32 registers of 32 bits, sp is r31 and lr is r30, pc (r29) is an ordinary register
+- the program is a separate word memory indexed by the program counter, data memory is flat, byte
+  addressed and little endian, sp starts at the top of it and the stack grows down a word at a time
+- b and jump offsets are relative to the branch, b rN jumps to the word index in rN, bl sets lr to the
+  next instruction
+- cmp compares signed words, b and cmov test the result with gt, le, eq, ne, lt, ge or always
+- the l / m variants apply to the 16 LSB / MSB of the destination only, an operand of an m variant
+  is moved into the 16 MSB first, movb applies to the 8 LSB
+- mul multiplies whole words, bytes (mulb), 16 LSB (mulhl) or 16 MSB (mulhm), signed for the muls* ones
+- ldm loads the listed registers from consecutive words, only the head register of a stm / push / pop
+  register range is encoded and moved
+- repeat #flag, #count, #length runs the next length instructions count times, the flag is not modelled
+- wait halts the simulation, as there are no masters or events to wake it up
+- the extension instructions take a step and do nothing
+"""
+
+import os
+import struct
+import operator
+import argparse
+
+from luna_asm import InstructionParser, assemble
+from luna_dis import Disassembler, read_words
+
+MASK32 = 0xFFFFFFFF
+
+# the program counter returned by an instruction that halts the simulation
+HALT = -1
+
+PART_WORD = 0
+PART_MSB = 1
+PART_LSB = 2
+PART_BYTE = 3
+
+
+def signed32(val):
+    return val - ((val >> 31) << 32)
+
+
+def merge_part(old, new, part):
+    """
+    the destination register after writing new into the given part of it
+    """
+    if part == PART_WORD:
+        return new & MASK32
+    if part == PART_MSB:
+        return (new & 0xFFFF0000) | (old & 0xFFFF)
+    if part == PART_LSB:
+        return (old & 0xFFFF0000) | (new & 0xFFFF)
+    return (old & 0xFFFFFF00) | (new & 0xFF)
+
+
+# condition code of b / cmov -> test of the last cmp result
+conditions = {
+    0b000: lambda flags: flags > 0,
+    0b001: lambda flags: flags <= 0,
+    0b010: lambda flags: flags == 0,
+    0b011: lambda flags: flags != 0,
+    0b100: lambda flags: flags < 0,
+    0b101: lambda flags: flags >= 0,
+    0b110: lambda flags: True,
+}
+
+# width bits of the ldr / str family -> (load format, signed load format, store format)
+memory_formats = {
+    0b00: (struct.Struct('<I'), struct.Struct('<I'), struct.Struct('<I')),
+    0b10: (struct.Struct('<B'), struct.Struct('<b'), struct.Struct('<B')),
+    0b01: (struct.Struct('<H'), struct.Struct('<h'), struct.Struct('<H')),
+}
+word_format = memory_formats[0b00][0]
+
+
+class Simulator(object):
+    """
+    every word is decoded once into a step function, step(pc) runs it and returns the next pc
+    """
+    # encoder of an op code in InstructionParser.op_dispatch -> predecode method
+    predecoders = {
+        'jump': 'predecode_jump',
+        'ldro': 'predecode_ldro',
+        'lea': 'predecode_lea',
+        'ldr': 'predecode_ldr',
+        'setr': 'predecode_setr',
+        'setr_mod': 'predecode_setr',
+        'gopr': 'predecode_gopr',
+        'gopr_mod': 'predecode_gopr',
+        'logic': 'predecode_logic',
+        'shift': 'predecode_shift',
+        'mul': 'predecode_mul',
+        'mov': 'predecode_mov',
+        'parse_op_wait': 'predecode_wait',
+        'parse_op_b': 'predecode_b',
+        'parse_op_ldm': 'predecode_ldm',
+        'parse_op_stm': 'predecode_stm',
+        'parse_op_pop': 'predecode_pop',
+        'parse_op_push': 'predecode_push',
+    }
+
+    def __init__(self, words, mem_size=1 << 20, extension=True):
+        self.regs = [0] * 32
+        self.mem = bytearray(mem_size)
+        self.regs[31] = mem_size  # sp
+        self.flags = 0  # the last cmp result, < 0, 0 or > 0
+        self.pc = 0
+        self.steps = 0
+        self.halted = False
+
+        disassembler = Disassembler(extension)
+        self.op_codes = []
+        self.program = []
+        repeats = []
+        for index, word in enumerate(words):
+            word = int(word)
+            entry, values = disassembler.decode(word)
+            if entry is None:
+                self.op_codes.append(None)
+                self.program.append(self.undefined(word))
+                continue
+            self.op_codes.append(entry.op_code)
+            encoder = InstructionParser.op_dispatch.get(entry.op_code, [None])[0]
+            if encoder == 'repeat':
+                # iterations left, shared by the repeat and the last instruction of its body
+                remaining = [0]
+                repeats.append((index, values, remaining))
+                self.program.append(self.predecode_repeat(word, values, remaining))
+                continue
+            if encoder not in self.predecoders:
+                # extension instructions
+                self.program.append(self.predecode_nop(word, values))
+                continue
+            self.program.append(getattr(self, self.predecoders[encoder])(word, values))
+
+        # the last instruction of a repeated body jumps back, inner loops are wrapped first
+        for index, values, remaining in reversed(repeats):
+            self.wrap_repeat(index, values, remaining)
+
+        # executions of every instruction
+        self.counts = [0] * len(self.program)
+
+    def run(self, max_steps=10000000):
+        """
+        run from pc until a wait, the end of the program or max_steps, returns the steps taken
+        """
+        program = self.program
+        counts = self.counts
+        count = len(program)
+        pc = self.pc
+        steps = 0
+        try:
+            while 0 <= pc < count and steps < max_steps:
+                counts[pc] += 1
+                pc = program[pc](pc)
+                steps += 1
+        except struct.error:
+            self.pc = pc
+            raise ValueError('memory access out of range at %d' % pc)
+        self.steps += steps
+        if pc == HALT:
+            self.halted = True
+        else:
+            self.pc = pc
+        return steps
+
+    def op_counts(self):
+        """
+        op code -> executions of it
+        """
+        totals = {}
+        for op_code, count in zip(self.op_codes, self.counts):
+            if count:
+                totals[op_code] = totals.get(op_code, 0) + count
+        return totals
+
+    def undefined(self, word):
+        def step(pc):
+            raise ValueError('undefined instruction 0x%08x at %d' % (word, pc))
+        return step
+
+    def source(self, word, values):
+        """
+        (register, immediate) of the source operand, one of them is None
+        """
+        if word & InstructionParser.SRC_IMM:
+            return None, values[-1]
+        return values[-1], None
+
+    def predecode_alu(self, d, word, values, op, part=PART_WORD):
+        """
+        step of rD = op(rD, source), the source moved into the 16 MSB for PART_MSB
+        the result is written into the part of rD
+        """
+        regs = self.regs
+        reg, imm = self.source(word, values)
+        shift = 16 if part == PART_MSB else 0
+        if reg is None:
+            val = imm << shift
+            if part == PART_WORD:
+                def step(pc):
+                    regs[d] = op(regs[d], val) & MASK32
+                    return pc + 1
+            else:
+                def step(pc):
+                    regs[d] = merge_part(regs[d], op(regs[d], val), part)
+                    return pc + 1
+        elif part == PART_WORD:
+            def step(pc):
+                regs[d] = op(regs[d], regs[reg]) & MASK32
+                return pc + 1
+        else:
+            def step(pc):
+                regs[d] = merge_part(regs[d], op(regs[d], regs[reg] << shift), part)
+                return pc + 1
+        return step
+
+    def predecode_nop(self, word, values):
+        def step(pc):
+            return pc + 1
+        return step
+
+    def predecode_wait(self, word, values):
+        def step(pc):
+            self.pc = pc
+            return HALT
+        return step
+
+    def predecode_jump(self, word, values):
+        offset = values[0]
+
+        def step(pc):
+            return pc + offset
+        return step
+
+    def predecode_repeat(self, word, values, remaining):
+        flag, count, length = values
+
+        def step(pc):
+            if count == 0:
+                return pc + 1 + length
+            remaining[0] = count - 1
+            return pc + 1
+        return step
+
+    def wrap_repeat(self, index, values, remaining):
+        flag, count, length = values
+        last = index + length
+        if length == 0 or last >= len(self.program):
+            return
+        body = self.program[last]
+        start = index + 1
+
+        def step(pc):
+            next_pc = body(pc)
+            if next_pc == last + 1 and remaining[0] > 0:
+                remaining[0] -= 1
+                return start
+            return next_pc
+        self.program[last] = step
+
+    def predecode_b(self, word, values):
+        regs = self.regs
+        test = conditions.get((word >> 19) & 0b111)
+        if test is None:
+            return self.undefined(word)
+        link = word & (0b1 << 22)
+        if word & (0b1 << 24):
+            offset = values[0]
+            if not link:
+                def step(pc):
+                    return pc + offset if test(self.flags) else pc + 1
+                return step
+
+            def target(pc):
+                return pc + offset
+        else:
+            reg = values[0]
+
+            def target(pc):
+                return regs[reg]
+
+        def step(pc):
+            if not test(self.flags):
+                return pc + 1
+            if link:
+                regs[30] = pc + 1
+            return target(pc)
+        return step
+
+    def predecode_gopr(self, word, values):
+        d = (word >> 16) & 0x1F
+        op_bits = word >> 26
+        if op_bits == InstructionParser.instruction_dict['cmp']:
+            regs = self.regs
+            reg, imm = self.source(word, values)
+
+            if reg is None:
+                def step(pc):
+                    x = regs[d]
+                    self.flags = x - ((x >> 31) << 32) - imm
+                    return pc + 1
+            else:
+                def step(pc):
+                    x = regs[d]
+                    v = regs[reg]
+                    self.flags = x - ((x >> 31) << 32) - v + ((v >> 31) << 32)
+                    return pc + 1
+            return step
+
+        mode = (word >> 21) & 0b111
+        part = mode & 0b11
+        if part == 0b11:
+            return self.undefined(word)
+        op = operator.sub if mode & 0b100 else operator.add
+        return self.predecode_alu(d, word, values, op, part)
+
+    def predecode_logic(self, word, values):
+        d = (word >> 16) & 0x1F
+        part = (word >> 21) & 0b11
+        if part == 0b11:
+            return self.undefined(word)
+        if word >> 26 == InstructionParser.instruction_dict['and']:
+            op = operator.and_ if word & (0b1 << 25) else (lambda x, v: ~v)
+        else:
+            op = operator.or_ if word & (0b1 << 25) else operator.xor
+        return self.predecode_alu(d, word, values, op, part)
+
+    def predecode_shift(self, word, values):
+        d = (word >> 16) & 0x1F
+        if word >> 26 == InstructionParser.instruction_dict['lsl']:
+            def op(x, v):
+                return x << (v & 0x1F)
+        elif word & (0b1 << 25):
+            def op(x, v):
+                return signed32(x) >> (v & 0x1F)
+        else:
+            def op(x, v):
+                return x >> (v & 0x1F)
+        return self.predecode_alu(d, word, values, op)
+
+    def predecode_mul(self, word, values):
+        regs = self.regs
+        d, s = values
+        mode = (word >> 21) & 0b111
+        signed = not mode & 0b100
+        size = mode & 0b11
+        # size bits -> (shift, mask) of the multiplied part
+        shift, mask = {0b00: (0, MASK32), 0b10: (0, 0xFF), 0b01: (0, 0xFFFF), 0b11: (16, 0xFFFF)}[size]
+        top = (mask + 1) >> 1
+
+        def part(val):
+            val = (val >> shift) & mask
+            if signed and val >= top:
+                val -= (mask + 1)
+            return val
+
+        def step(pc):
+            regs[d] = (part(regs[d]) * part(regs[s])) & MASK32
+            return pc + 1
+        return step
+
+    def predecode_mov(self, word, values):
+        d = (word >> 16) & 0x1F
+        if word >> 26 == InstructionParser.instruction_dict['cmov']:
+            regs = self.regs
+            reg, imm = self.source(word, values)
+            test = conditions.get((word >> 21) & 0b111)
+            if test is None:
+                return self.undefined(word)
+
+            def step(pc):
+                if test(self.flags):
+                    regs[d] = (imm if reg is None else regs[reg]) & MASK32
+                return pc + 1
+            return step
+
+        # width bits -> part of the destination
+        part = {0b00: PART_WORD, 0b01: PART_LSB, 0b10: PART_BYTE, 0b11: PART_MSB}[(word >> 21) & 0b11]
+        return self.predecode_alu(d, word, values, lambda x, v: v, part)
+
+    def predecode_setr(self, word, values):
+        regs = self.regs
+        d = (word >> 16) & 0x1F
+        mode = (word >> 21) & 0b11111
+        imm = word & 0xFFFF
+        if mode & 0b00011:
+            part = PART_MSB
+        elif mode & 0b01100:
+            part = PART_LSB
+        else:
+            return self.undefined(word)
+        shift = 16 if part == PART_MSB else 0
+
+        def step(pc):
+            regs[d] = merge_part(regs[d], imm << shift, part)
+            return pc + 1
+        return step
+
+    def predecode_ldr(self, word, values):
+        regs = self.regs
+        mem = self.mem
+        d, base = values
+        formats = memory_formats.get((word >> 21) & 0b11)
+        if formats is None:
+            return self.undefined(word)
+        if word >> 26 == InstructionParser.instruction_dict['str']:
+            fmt = formats[2]
+            mask = (1 << (fmt.size * 8)) - 1
+
+            def step(pc):
+                fmt.pack_into(mem, regs[base], regs[d] & mask)
+                return pc + 1
+            return step
+
+        fmt = formats[0] if word & (0b1 << 25) else formats[1]
+
+        def step(pc):
+            regs[d] = fmt.unpack_from(mem, regs[base])[0] & MASK32
+            return pc + 1
+        return step
+
+    def predecode_ldro(self, word, values):
+        regs = self.regs
+        mem = self.mem
+        d, base, offset = values
+        if word >> 26 == InstructionParser.instruction_dict['stro']:
+            def step(pc):
+                word_format.pack_into(mem, (regs[base] + offset) & MASK32, regs[d])
+                return pc + 1
+            return step
+
+        def step(pc):
+            regs[d] = word_format.unpack_from(mem, (regs[base] + offset) & MASK32)[0]
+            return pc + 1
+        return step
+
+    def predecode_lea(self, word, values):
+        regs = self.regs
+        d, base, offset = values
+
+        def step(pc):
+            regs[d] = (regs[base] + offset) & MASK32
+            return pc + 1
+        return step
+
+    def predecode_ldm(self, word, values):
+        regs = self.regs
+        mem = self.mem
+        base, head, msk = values
+        loaded = [head] + [head + i for i in range(1, 8) if not (msk >> (i - 1)) & 1]
+        if loaded[-1] > 31:
+            return self.undefined(word)
+        slots = [(reg, i * 4) for i, reg in enumerate(loaded)]
+
+        def step(pc):
+            addr = regs[base]
+            for reg, offset in slots:
+                regs[reg] = word_format.unpack_from(mem, addr + offset)[0]
+            return pc + 1
+        return step
+
+    def predecode_stm(self, word, values):
+        regs = self.regs
+        mem = self.mem
+        base, head = values
+
+        def step(pc):
+            word_format.pack_into(mem, regs[base], regs[head])
+            return pc + 1
+        return step
+
+    def predecode_pop(self, word, values):
+        regs = self.regs
+        mem = self.mem
+        d = values[0]
+
+        def step(pc):
+            regs[d] = word_format.unpack_from(mem, regs[31])[0]
+            regs[31] = (regs[31] + 4) & MASK32
+            return pc + 1
+        return step
+
+    def predecode_push(self, word, values):
+        regs = self.regs
+        mem = self.mem
+        s = values[0]
+
+        def step(pc):
+            regs[31] = (regs[31] - 4) & MASK32
+            word_format.pack_into(mem, regs[31], regs[s])
+            return pc + 1
+        return step
+
+
+def load_program(file_path, endian='little'):
+    """
+    the words of a .s source, assembled in memory, or of a .hex / binary image
+    """
+    if file_path.endswith('.s'):
+        with open(os.path.abspath(file_path), 'r') as f:
+            return assemble(f.read()).words
+    return read_words(file_path, endian)
+
+
+def parse_args():
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument('-i', type=str, required=True,
+                            help='path to the program, a .s source, a .hex file or a raw binary file.')
+    arg_parser.add_argument('--endian', type=str, choices=['little', 'big'], default='little',
+                            help='byte order of the words in a binary image. Default with little.')
+    arg_parser.add_argument('--max-steps', type=int, default=10000000,
+                            help='instructions executed before the simulation stops. Default with 10000000.')
+    arg_parser.add_argument('--mem-size', type=lambda x: int(x, 0), default=1 << 20,
+                            help='bytes of data memory. Default with 1 MiB.')
+    arg_parser.add_argument('--counts', action='store_true',
+                            help='print the executions of every op code.')
+    arg_parser.add_argument('--regs', action='store_true',
+                            help='print the registers at the end of the simulation.')
+    args = vars(arg_parser.parse_args())
+    return args
+
+
+if __name__ == "__main__":
+    args = parse_args()
+
+    simulator = Simulator(load_program(args['i'], args['endian']), args['mem_size'])
+    steps = simulator.run(args['max_steps'])
+
+    if simulator.halted:
+        print('--- %d instructions executed, halted by wait at %d' % (steps, simulator.pc))
+    elif steps >= args['max_steps']:
+        print('--- %d instructions executed, stopped by --max-steps at %d' % (steps, simulator.pc))
+    else:
+        print('--- %d instructions executed, left the program at %d' % (steps, simulator.pc))
+
+    if args['counts']:
+        totals = simulator.op_counts()
+        for op_code in sorted(totals, key=lambda each: -totals[each]):
+            print('%-10s %d' % (op_code, totals[op_code]))
+    if args['regs']:
+        for i in range(0, 32, 4):
+            print('  '.join('r%-2d %08x' % (r, simulator.regs[r]) for r in range(i, i + 4)))
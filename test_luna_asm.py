@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+
+import os
+import tempfile
+import unittest
+
+from luna_asm import InstructionParser, InstructionBuilder, parse_args, main
+
+
+class EncodeCacheTest(unittest.TestCase):
+
+    def encode(self, inst_parser, insts):
+        return [inst_parser.encode_instruction(each, [], 0) for each in insts]
+
+    def test_size_0_turns_the_cache_off(self):
+        inst_parser = InstructionParser(True)
+        inst_parser.encode_cache_size = 0
+        codes = self.encode(inst_parser, ['add r1, #1', 'add r1, #1', 'sub r2, #2'])
+        self.assertEqual(codes, self.encode(InstructionParser(True), ['add r1, #1', 'add r1, #1', 'sub r2, #2']))
+        self.assertEqual(len(inst_parser.encode_cache), 0)
+        self.assertEqual(inst_parser.encode_cache_info()['hits'], 0)
+
+    def test_size_1_keeps_the_last_instruction(self):
+        inst_parser = InstructionParser(True)
+        inst_parser.encode_cache_size = 1
+        self.encode(inst_parser, ['add r1, #1', 'add r1, #1', 'sub r2, #2', 'add r1, #1'])
+        self.assertEqual(list(inst_parser.encode_cache), ['add r1, #1'])
+        info = inst_parser.encode_cache_info()
+        self.assertEqual((info['hits'], info['misses']), (1, 3))
+
+    def test_tabs_hit_the_cache(self):
+        inst_parser = InstructionParser(True)
+        self.encode(inst_parser, ['add\tr1, #1'] * 3)
+        info = inst_parser.encode_cache_info()
+        self.assertEqual((info['hits'], info['misses']), (2, 1))
+
+
+class OutputFilesTest(unittest.TestCase):
+
+    def test_error_leaves_no_partial_output(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            source = os.path.join(tmp_dir, 'bad.s')
+            with open(source, 'w') as f:
+                f.write('main:\n    add r1, #1\n    sub r2, #2\n    add r1, #zz\n')
+            output = os.path.join(tmp_dir, 'out')
+            with self.assertRaises(ValueError):
+                main(parse_args(['-i', source, '-o', output, '-f', 'c,h,hex']))
+            self.assertEqual(os.listdir(tmp_dir), ['bad.s'])
+
+
+class InstructionBuilderTest(unittest.TestCase):
+
+    def test_trailing_label_raises(self):
+        builder = InstructionBuilder()
+        builder.label('main').add('r1', 1).label('end')
+        with self.assertRaises(ValueError):
+            builder.build()
+
+    def test_label_before_instruction(self):
+        builder = InstructionBuilder()
+        builder.label('main').add('r1', 1).label('end').sub('r2', 2)
+        self.assertEqual(builder.build().labels, {'main': 0, 'end': 1})
+
+
+if __name__ == '__main__':
+    unittest.main()